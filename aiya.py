@@ -3,7 +3,9 @@ import discord
 import os
 import sys
 from core import ctxmenuhandler
+from core import journalhandler
 from core import settings
+from core import statshandler
 from core.logging import get_logger
 from dotenv import load_dotenv
 from core.queuehandler import GlobalQueue
@@ -31,9 +33,15 @@ self.load_extension('core.generatecog')
 # stats slash command
 @self.slash_command(name='stats', description='How many images have I generated?')
 async def stats(ctx):
-    with open('resources/stats.txt', 'r') as f:
-        data = list(map(int, f.readlines()))
-    embed = discord.Embed(title='Art generated', description=f'I have created {data[0]} pictures!',
+    total, users, models, commands = statshandler.stats.snapshot()
+    description = f'I have created {total} pictures!'
+    if commands:
+        description += '\n' + ', '.join(f'{name}: {count}' for name, count in commands.most_common())
+    if models:
+        model, count = models.most_common(1)[0]
+        description += f'\nFavorite model: ``{model}`` ({count} pictures)'
+    description += f'\nYou have asked me for {users[str(ctx.author.id)]} things.'
+    embed = discord.Embed(title='Art generated', description=description,
                           color=settings.global_var.embed_color)
     await ctx.respond(embed=embed)
 
@@ -42,6 +50,8 @@ async def stats(ctx):
 async def queue(ctx):
     queue_sizes = GlobalQueue.get_queue_sizes()
     description = '\n'.join([f'{name}: {size}' for name, size in queue_sizes.items()])
+    description += f'\n\nModel swaps avoided: {GlobalQueue.scheduler.swaps_avoided}'
+    description += f'\nImage info cache: {ctxmenuhandler.info_cache.hits} hits, {ctxmenuhandler.info_cache.misses} misses'
     embed = discord.Embed(title='Queue Sizes', description=description, 
                           color=settings.global_var.embed_color)
     await ctx.respond(embed=embed)
@@ -65,6 +75,8 @@ async def batch_download(ctx, message: discord.Message):
 @self.event
 async def on_ready():
     self.logger.info(f'Logged in as {self.user.name} ({self.user.id})')
+    GlobalQueue.scheduler.start()
+    await journalhandler.resume(self)
     await self.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name='drawing tutorials.'))
     for guild in self.guilds:
         print(f"I'm active in {guild.id} a.k.a {guild}!")
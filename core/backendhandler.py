@@ -0,0 +1,331 @@
+import aiohttp
+import asyncio
+import json
+import requests
+import threading
+import time
+
+
+# one Web UI instance that jobs can be sent to
+class Backend:
+    def __init__(self, url, weight=1):
+        self.url = url.rstrip('/')
+        self.weight = max(float(weight), 0.1)
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+        self.retry_at = 0.0
+        self.gradio_auth = None
+        # one long-lived session per backend, so connections and logins are reused between jobs
+        self.session = None
+        self.session_lock = threading.Lock()
+        # and the same for jobs on the event loop
+        self.client = None
+        # what the backend's options are set to, None until they're fetched again
+        self.options = None
+        self.options_lock = asyncio.Lock()
+
+    def load(self):
+        return self.outstanding / self.weight
+
+    # the checkpoint this backend has loaded, if known
+    @property
+    def sd_model(self):
+        options = self.options
+        if options is None:
+            return None
+        return options.get('sd_model_checkpoint')
+
+    # only used at startup, before any jobs can be setting options at the same time
+    def fetch_options(self, session):
+        response = session.get(f'{self.url}/sdapi/v1/options')
+        self.options = response.json() if response.status_code == 200 else {}
+
+    # ask again for what the backend has set, anything changed on the Web UI itself isn't known until then
+    async def refresh_options(self, client):
+        async with self.options_lock:
+            self.options = None
+            response = await client.options()
+            if response.status_code == 200:
+                self.options = response.json()
+
+    # only post the options that are different from what the backend has now.
+    # the options can be forgotten from another thread at any time, so this works on its own reference to them
+    async def set_options(self, client, options):
+        async with self.options_lock:
+            known = self.options
+            if known is None:
+                response = await client.options()
+                known = response.json() if response.status_code == 200 else {}
+                self.options = known
+            changed = {key: value for key, value in options.items() if known.get(key) != value}
+            if changed:
+                response = await client.set_options(changed)
+                if response.status_code == 200:
+                    known.update(changed)
+                else:
+                    self.options = None
+            return changed
+
+    def available(self):
+        return self.healthy or time.time() >= self.retry_at
+
+    # back off a little longer after each failure in a row, up to five minutes
+    def mark_down(self):
+        self.failures += 1
+        self.healthy = False
+        # it may come back after a restart with other options, so look again next time
+        self.options = None
+        self.retry_at = time.time() + min(300, 15 * 2 ** (self.failures - 1))
+        print(f'Web UI at {self.url} is unreachable! Trying other backends for a while.')
+
+    def mark_up(self):
+        if not self.healthy:
+            print(f'Web UI at {self.url} is back!')
+            # it may have come back with another checkpoint loaded
+            self.options = None
+        self.failures = 0
+        self.healthy = True
+
+
+# a session that keeps the backend health state up to date and logs in again if the Web UI forgot about it
+class BackendSession(requests.Session):
+    def __init__(self, backend: Backend, login_payload=None):
+        super().__init__()
+        self.backend = backend
+        self.login_payload = login_payload
+        self.login_lock = threading.Lock()
+        # goes up with each login, so a thread that waited on another's login doesn't log in again after it
+        self.logins = 0
+
+    def send_request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', pool.timeout)
+        try:
+            response = super().request(method, url, **kwargs)
+        except requests.exceptions.ConnectionError:
+            self.backend.mark_down()
+            raise
+        self.backend.mark_up()
+        return response
+
+    # only log in when --gradio-auth is set, which shows as cmd-flags turning us away.
+    # True if the request that was turned away is worth trying again
+    def login(self, seen=None):
+        with self.login_lock:
+            if seen is not None and seen != self.logins:
+                return True
+            if self.backend.gradio_auth is None:
+                response = self.send_request('GET', f'{self.backend.url}/sdapi/v1/cmd-flags')
+                self.backend.gradio_auth = response.status_code == 401
+            if not self.backend.gradio_auth:
+                return False
+            response = self.send_request('POST', f'{self.backend.url}/login', data=self.login_payload)
+            if response.status_code != 200:
+                raise PermissionError(f"Couldn't log in to the Web UI at {self.backend.url}: {response.status_code}")
+            self.logins += 1
+            return True
+
+    def request(self, method, url, **kwargs):
+        seen = self.logins
+        response = self.send_request(method, url, **kwargs)
+        # a restarted Web UI has forgotten the login, or it hasn't been checked for one yet.
+        # log in once more and try again
+        if response.status_code == 401 and self.backend.gradio_auth is not False and self.login(seen):
+            response = self.send_request(method, url, **kwargs)
+        return response
+
+
+# what the Web UI answered, read in full so the connection can go back to the pool
+class ApiResponse:
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+# the event loop's version of BackendSession, jobs await it instead of tying up a thread
+class BackendClient:
+    def __init__(self, backend: Backend, login_payload=None, api_auth=None):
+        self.backend = backend
+        self.login_payload = login_payload
+        self.api_auth = aiohttp.BasicAuth(*api_auth) if api_auth else None
+        self.session = None
+        self.logged_in = False
+        self.login_lock = asyncio.Lock()
+        # goes up with each login, so a job that waited on another's login doesn't log in again after it
+        self.logins = 0
+
+    # the session has to be made on the loop it's used from
+    def open(self):
+        if self.session is None or self.session.closed:
+            timeout = aiohttp.ClientTimeout(sock_connect=pool.timeout[0], sock_read=pool.timeout[1])
+            # the Web UI is usually reached by IP address, which aiohttp won't keep the login cookie for by default
+            self.session = aiohttp.ClientSession(auth=self.api_auth, timeout=timeout,
+                                                 cookie_jar=aiohttp.CookieJar(unsafe=True))
+        return self.session
+
+    async def send_request(self, method, path, **kwargs):
+        try:
+            async with self.open().request(method, f'{self.backend.url}{path}', **kwargs) as response:
+                status_code = response.status
+                text = await response.text()
+        except (aiohttp.ClientConnectorError, aiohttp.ServerDisconnectedError):
+            self.backend.mark_down()
+            raise
+        self.backend.mark_up()
+        try:
+            data = json.loads(text)
+        except ValueError:
+            data = text
+        return ApiResponse(status_code, data)
+
+    # True if the request that was turned away is worth trying again
+    async def login(self, seen=None):
+        async with self.login_lock:
+            if seen is not None and seen != self.logins:
+                return True
+            if self.backend.gradio_auth is None:
+                response = await self.send_request('GET', '/sdapi/v1/cmd-flags')
+                self.backend.gradio_auth = response.status_code == 401
+            self.logged_in = True
+            if not self.backend.gradio_auth:
+                return False
+            response = await self.send_request('POST', '/login', data=self.login_payload)
+            if response.status_code != 200:
+                raise PermissionError(f"Couldn't log in to the Web UI at {self.backend.url}: {response.status_code}")
+            self.logins += 1
+            return True
+
+    async def request(self, method, path, **kwargs):
+        if not self.logged_in:
+            await self.login()
+        seen = self.logins
+        response = await self.send_request(method, path, **kwargs)
+        # a restarted Web UI has forgotten the login, or it hasn't been checked for one yet.
+        # log in once more and try again
+        if response.status_code == 401 and self.backend.gradio_auth is not False and await self.login(seen):
+            response = await self.send_request(method, path, **kwargs)
+        return response
+
+    async def get(self, path):
+        return await self.request('GET', path)
+
+    async def post(self, path, payload):
+        return await self.request('POST', path, json=payload)
+
+    async def txt2img(self, payload):
+        return await self.post('/sdapi/v1/txt2img', payload)
+
+    async def img2img(self, payload):
+        return await self.post('/sdapi/v1/img2img', payload)
+
+    async def extra_single_image(self, payload):
+        return await self.post('/sdapi/v1/extra-single-image', payload)
+
+    async def interrogate(self, payload):
+        return await self.post('/sdapi/v1/interrogate', payload)
+
+    async def png_info(self, image):
+        return await self.post('/sdapi/v1/png-info', {'image': 'data:image/png;base64,' + image})
+
+    async def options(self):
+        return await self.get('/sdapi/v1/options')
+
+    async def set_options(self, options):
+        return await self.post('/sdapi/v1/options', options)
+
+    # samplers, prompt-styles, face-restorers, embeddings, hypernetworks, upscalers, sd-models
+    async def catalog(self, name):
+        return await self.get(f'/sdapi/v1/{name}')
+
+
+# an image from a URL given to a command, downloaded once when the command checks it
+class RemoteImage:
+    def __init__(self, url, content):
+        self.url = url
+        self.content = content
+
+
+# routes each job to the available backend with the least outstanding jobs for its weight
+class BackendPool:
+    def __init__(self):
+        self.backends: list[Backend] = []
+        self.lock = threading.Lock()
+        # how many jobs each backend is given at once
+        self.jobs_per_backend = 1
+        # seconds to wait for a connection and for a response
+        self.timeout = (10, 600)
+        # plain downloads like Discord attachments, kept apart from the backends' logins
+        self.download_session = None
+
+    # config is loaded again on refresh, so keep the state of backends that are still listed
+    def configure(self, url, extra_backends):
+        entries = [{'url': url}]
+        for entry in extra_backends:
+            # entries can be a plain URL or a table like {url = "...", weight = 2}
+            if isinstance(entry, str):
+                entry = {'url': entry}
+            entries.append(entry)
+
+        existing = {x.url: x for x in self.backends}
+        backends = {}
+        for entry in entries:
+            backend = Backend(str(entry['url']), entry.get('weight', 1))
+            if backend.url in existing:
+                existing[backend.url].weight = backend.weight
+                backend = existing[backend.url]
+            backends[backend.url] = backend
+        with self.lock:
+            self.backends = list(backends.values())
+
+    def primary(self):
+        return self.backends[0]
+
+    def capacity(self):
+        return len(self.backends) * self.jobs_per_backend
+
+    # a backend that's down doesn't count, jobs wait for one that's up instead of failing on it
+    def has_room(self):
+        return any(x.outstanding < self.jobs_per_backend and x.available() for x in self.backends)
+
+    # only called when has_room() says there's a backend to give out
+    def acquire(self):
+        with self.lock:
+            candidates = [x for x in self.backends if x.outstanding < self.jobs_per_backend and x.available()]
+            backend = min(candidates, key=lambda x: x.load())
+            backend.outstanding += 1
+            return backend
+
+    # seconds until a backend that's down and has room can be tried again, None if there isn't one
+    def retry_delay(self):
+        retries = [x.retry_at for x in self.backends if x.outstanding < self.jobs_per_backend and not x.available()]
+        if not retries:
+            return None
+        return max(min(retries) - time.time(), 0)
+
+    def release(self, backend: Backend):
+        with self.lock:
+            backend.outstanding -= 1
+
+    def downloads(self):
+        if self.download_session is None or self.download_session.closed:
+            timeout = aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1])
+            self.download_session = aiohttp.ClientSession(timeout=timeout)
+        return self.download_session
+
+    async def download(self, url):
+        async with self.downloads().get(url) as response:
+            response.raise_for_status()
+            return await response.read()
+
+
+# the bytes of an image given to a job, only downloading it if the command didn't already
+async def read_image(image):
+    if getattr(image, 'content', None) is not None:
+        return image.content
+    return await pool.download(image if isinstance(image, str) else image.url)
+
+
+pool = BackendPool()
@@ -0,0 +1,67 @@
+import threading
+
+
+# a rough guess of the GPU time a job needs, in units of one 512x512 sampling step
+def raw_cost(queue_object):
+    kind = type(queue_object).__name__
+    if kind == 'DrawObject':
+        pixels = queue_object.width * queue_object.height / (512 * 512)
+        images = queue_object.batch[0] * queue_object.batch[1]
+        try:
+            strength = float(queue_object.strength)
+        except(Exception,):
+            strength = 0.75
+        # steps can come back from an edited draw as text
+        try:
+            steps = int(queue_object.steps)
+        except(Exception,):
+            steps = 30
+        # img2img only runs the share of steps that the strength asks for
+        cost = pixels * (steps * strength if queue_object.init_image is not None else steps)
+        # high-res fix runs a second img2img pass over each image
+        if queue_object.highres_fix != 'Disabled':
+            cost += pixels * steps * strength
+        # face restoration is about a couple of steps' worth per image
+        if queue_object.facefix != 'None':
+            cost += 2
+        return max(cost * images, 1)
+    if kind == 'UpscaleObject':
+        try:
+            resize = float(queue_object.resize)
+        except(Exception,):
+            resize = 2.0
+        return 10 * resize * resize
+    if kind == 'IdentifyObject':
+        return 20
+    return 1
+
+
+# the guesses are brought in line with how long jobs really take as they finish
+class CostModel:
+    def __init__(self):
+        # seconds one unit takes, measured from draws
+        self.seconds_per_unit = 0.1
+        # how far off the guess is for other kinds of jobs, measured against the draws
+        self.scale = {'UpscaleObject': 1.0, 'IdentifyObject': 1.0}
+        # how much each new measurement moves the numbers
+        self.smoothing = 0.2
+        self.lock = threading.Lock()
+
+    def estimate(self, queue_object):
+        return raw_cost(queue_object) * self.scale.get(type(queue_object).__name__, 1.0)
+
+    def seconds(self, cost):
+        return cost * self.seconds_per_unit
+
+    # a single measurement can only move the numbers a little, so one failed or stuck job can't throw them off
+    def record(self, queue_object, seconds):
+        kind = type(queue_object).__name__
+        raw = raw_cost(queue_object) + sum(raw_cost(x) for x in getattr(queue_object, 'merged', []))
+        with self.lock:
+            if kind == 'DrawObject':
+                sample = min(max(seconds / raw, self.seconds_per_unit / 4), self.seconds_per_unit * 4)
+                self.seconds_per_unit += self.smoothing * (sample - self.seconds_per_unit)
+            elif kind in self.scale:
+                sample = seconds / self.seconds_per_unit / raw
+                sample = min(max(sample, self.scale[kind] / 4), self.scale[kind] * 4)
+                self.scale[kind] += self.smoothing * (sample - self.scale[kind])
@@ -1,9 +1,14 @@
 import base64
 import discord
 import re
-import requests
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
 from urlextract import URLExtract
 
+from core import backendhandler
+from core import imagehandler
+from core import outputhandler
 from core import settings
 from core import queuehandler
 from core import upscalecog
@@ -40,102 +45,157 @@ def style_remove(search, field):
     return field.strip(',')
 
 
-async def parse_image_info(ctx, image_url, command):
-    message = ''
-    try:
-        # construct a payload
-        image = base64.b64encode(requests.get(image_url, stream=True).content).decode('utf-8')
-        payload = {
-            "image": 'data:image/png;base64,' + image
-        }
-        # send normal payload to webui
-        s = settings.authenticate_user()
-        png_response = s.post(url=f'{settings.global_var.url}/sdapi/v1/png-info', json=payload)
+# parsed image info is kept for a while, since popular images get looked at by a lot of people
+class InfoCache:
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # catalogs are loaded again on refresh, which can change how models and styles are matched
+        self.catalog_version = None
+
+    # Discord links carry an expiring signature that changes between views of the same attachment
+    def key(self, image_url):
+        parts = urlsplit(image_url)
+        if parts.hostname in ('cdn.discordapp.com', 'media.discordapp.net'):
+            return parts.hostname + parts.path
+        return image_url
+
+    def get(self, image_url):
+        if self.catalog_version != settings.global_var.catalog_version:
+            self.entries.clear()
+            self.catalog_version = settings.global_var.catalog_version
+        key = self.key(image_url)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.time():
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, image_url, info):
+        key = self.key(image_url)
+        self.entries[key] = (time.time() + settings.global_var.info_cache_ttl, info)
+        self.entries.move_to_end(key)
+        while len(self.entries) > settings.global_var.info_cache_size:
+            self.entries.popitem(last=False)
+
+
+async def read_image_info(image_url):
+    info = info_cache.get(image_url)
+    if info is not None:
+        return info
+
+    # read the parameters straight from the PNG's text chunks
+    png_data = await imagehandler.read_parameters(image_url)
+    # the Web UI can also read them from JPEG and WebP
+    if png_data is None:
+        image = base64.b64encode(await backendhandler.pool.download(image_url)).decode('utf-8')
+        client = settings.authenticate_client()
+        png_response = await client.png_info(image)
         png_data = png_response.json().get("info")
-        png_data_list = png_data.split("\n")
+    info = parse_info(png_data)
+    info_cache.put(image_url, info)
+    return info
 
-        # grab prompt and negative prompt
-        prompt_field = png_data_list[0]
-        if "Negative prompt: " in png_data_list[1]:
-            negative_prompt = str(png_data_list[1]).split("Negative prompt: ", 1)[1]
-        else:
-            negative_prompt = ''
-            png_data_list.insert(1, '')
-
-        # initialize model info
-        display_name, model_name, model_hash = 'Unknown', 'Unknown', 'Unknown'
-        activator_token = ''
-
-        # initialize extra params
-        steps, size, guidance_scale, sampler, seed = '', '', '', '', ''
-        style, facefix, highres_fix, clip_skip = '', '', '', ''
-        strength, has_init_url = '', False
-        if command == 'button' and ctx is not None:
-            has_init_url = True
-
-        # try to find extra networks
-        hypernet, lora = extra_net_search(prompt_field)
-
-        # try to find the style used and remove from prompts
-        for key, value in settings.global_var.style_names.items():
-            try:
-                style_prompt = list(value)
-                if style_search(style_prompt[0], prompt_field) and style_search(style_prompt[1], negative_prompt):
-                    style = [key, value]
-                    break
-            except(Exception,):
-                pass
-        # if style is not none then remove its tokens from prompts
-        if style:
-            prompt_field = style_remove(style[1][0], prompt_field)
-            negative_prompt = style_remove(style[1][1], negative_prompt)
-
-        # grab parameters
-        extra_params_split = png_data_list[2].split(", ")
-        for line in extra_params_split:
-            if 'Model hash: ' in line:
-                model_hash = line.split(': ', 1)[1]
-            if 'Model: ' in line:
-                model_name = line.split(': ', 1)[1]
-
-            if 'Steps: ' in line:
-                steps = line.split(': ', 1)[1]
-            if 'Size: ' in line:
-                size = line.split(': ', 1)[1]
-            if 'CFG scale: ' in line:
-                guidance_scale = line.split(': ', 1)[1]
-            if 'Sampler: ' in line:
-                sampler = line.split(': ', 1)[1]
-            if 'Seed: ' in line:
-                seed = line.split(': ', 1)[1]
-
-            if 'Face restoration: ' in line:
-                facefix = line.split(': ', 1)[1]
-            if 'Hires upscaler: ' in line:
-                highres_fix = line.split(': ', 1)[1]
-            if 'Clip skip: ' in line:
-                clip_skip = line.split(': ', 1)[1]
-
-            if 'Denoising strength: ' in line:
-                strength = line.split(': ', 1)[1]
 
-        width_height = size.split("x")
+# pull the prompts, model, style and other parameters out of an image's info string
+def parse_info(png_data):
+    png_data_list = png_data.split("\n")
+
+    # grab prompt and negative prompt
+    prompt_field = png_data_list[0]
+    if "Negative prompt: " in png_data_list[1]:
+        negative_prompt = str(png_data_list[1]).split("Negative prompt: ", 1)[1]
+    else:
+        negative_prompt = ''
+        png_data_list.insert(1, '')
+
+    # initialize model info
+    display_name, model_name, model_hash = 'Unknown', 'Unknown', 'Unknown'
+    activator_token = ''
+
+    # initialize extra params
+    steps, size, guidance_scale, sampler, seed = '', '', '', '', ''
+    style, facefix, highres_fix, clip_skip = '', '', '', ''
+    strength = ''
+
+    # try to find extra networks
+    hypernet, lora = extra_net_search(prompt_field)
+
+    # try to find the style used and remove from prompts
+    for key, value in settings.global_var.style_names.items():
+        try:
+            style_prompt = list(value)
+            if style_search(style_prompt[0], prompt_field) and style_search(style_prompt[1], negative_prompt):
+                style = [key, value]
+                break
+        except(Exception,):
+            pass
+    # if style is not none then remove its tokens from prompts
+    if style:
+        prompt_field = style_remove(style[1][0], prompt_field)
+        negative_prompt = style_remove(style[1][1], negative_prompt)
+
+    # grab parameters
+    extra_params_split = png_data_list[2].split(", ")
+    for line in extra_params_split:
+        if 'Model hash: ' in line:
+            model_hash = line.split(': ', 1)[1]
+        if 'Model: ' in line:
+            model_name = line.split(': ', 1)[1]
+
+        if 'Steps: ' in line:
+            steps = line.split(': ', 1)[1]
+        if 'Size: ' in line:
+            size = line.split(': ', 1)[1]
+        if 'CFG scale: ' in line:
+            guidance_scale = line.split(': ', 1)[1]
+        if 'Sampler: ' in line:
+            sampler = line.split(': ', 1)[1]
+        if 'Seed: ' in line:
+            seed = line.split(': ', 1)[1]
+
+        if 'Face restoration: ' in line:
+            facefix = line.split(': ', 1)[1]
+        if 'Hires upscaler: ' in line:
+            highres_fix = line.split(': ', 1)[1]
+        if 'Clip skip: ' in line:
+            clip_skip = line.split(': ', 1)[1]
+
+        if 'Denoising strength: ' in line:
+            strength = line.split(': ', 1)[1]
+
+    # try to find the model name and activator token
+    for model in settings.global_var.model_info.items():
+        if model[1][2] == model_hash or model[1][1] == model_name:
+            display_name = model[0]
+            if model[1][3]:
+                activator_token = f"\nActivator token - ``{model[1][3]}``"
+                prompt_field = prompt_field.replace(f"{model[1][3]} ", "")
+    # strip any folders from model name
+    model_name = model_name.split('_', 1)[-1]
+
+    # run prompts through mod function
+    mod_results = settings.prompt_mod(prompt_field, negative_prompt)
+    if mod_results[0] == "Mod":
+        prompt_field = mod_results[1]
+        negative_prompt = mod_results[3]
+
+    return (prompt_field, negative_prompt, display_name, model_name, model_hash, activator_token, steps, size,
+            guidance_scale, sampler, seed, style, facefix, highres_fix, clip_skip, strength, hypernet, lora)
+
 
-        # try to find the model name and activator token
-        for model in settings.global_var.model_info.items():
-            if model[1][2] == model_hash or model[1][1] == model_name:
-                display_name = model[0]
-                if model[1][3]:
-                    activator_token = f"\nActivator token - ``{model[1][3]}``"
-                    prompt_field = prompt_field.replace(f"{model[1][3]} ", "")
-        # strip any folders from model name
-        model_name = model_name.split('_', 1)[-1]
-
-        # run prompts through mod function
-        mod_results = settings.prompt_mod(prompt_field, negative_prompt)
-        if mod_results[0] == "Mod":
-            prompt_field = mod_results[1]
-            negative_prompt = mod_results[3]
+async def parse_image_info(ctx, image_url, command):
+    message = ''
+    try:
+        info = await read_image_info(image_url)
+        (prompt_field, negative_prompt, display_name, model_name, model_hash, activator_token, steps, size,
+         guidance_scale, sampler, seed, style, facefix, highres_fix, clip_skip, strength, hypernet, lora) = info
+        has_init_url = command == 'button' and ctx is not None
+        width_height = size.split("x")
 
         # create embed and give the best effort in trying to parse the png info
         embed = discord.Embed(title="About the image!", description="")
@@ -240,7 +300,11 @@ async def quick_upscale(self, ctx, message: discord.Message):
     settings.check(channel)
     upscaler_1 = settings.read(channel)['upscaler_1']
 
-    init_image = requests.get(urls[0])
+    try:
+        init_image = backendhandler.RemoteImage(urls[0], await backendhandler.pool.download(urls[0]))
+    except(Exception,):
+        await ctx.respond(content="I couldn't get the image from that message...", ephemeral=True)
+        return
     resize = settings.global_var.quick_upscale_resize
     upscaler_2, upscaler_2_strength = "None", '0.5'
     gfpgan, codeformer = '0.0', '0.0'
@@ -254,21 +318,16 @@ async def quick_upscale(self, ctx, message: discord.Message):
     input_tuple = (
         ctx, resize, init_image, upscaler_1, upscaler_2, upscaler_2_strength, gfpgan, codeformer, upscale_first)
     view = viewhandler.DeleteView(input_tuple)
-    user_queue_limit = settings.queue_check(ctx.author)
     upscale_dream = upscalecog.UpscaleCog(self)
-    if queuehandler.GlobalQueue.dream_thread.is_alive():
-        if user_queue_limit == "Stop":
-            await ctx.send_response(
-                content=f"Please wait! You're past your queue limit of {settings.global_var.queue_limit}.",
-                ephemeral=True)
-        else:
-            queuehandler.GlobalQueue.queue.append(queuehandler.UpscaleObject(upscale_dream, *input_tuple, view))
-    else:
-        await queuehandler.process_dream(upscale_dream, queuehandler.UpscaleObject(upscale_dream, *input_tuple, view))
-    if user_queue_limit != "Stop":
-        await ctx.send_response(
-            f'<@{ctx.author.id}>, upscaling {message}by ``{resize}``x using ``{upscaler_1}``!\n'
-            f'Queue: ``{len(queuehandler.GlobalQueue.queue)}``', delete_after=45.0)
+    upscale_object = queuehandler.UpscaleObject(upscale_dream, *input_tuple, view)
+    check = settings.queue_check(ctx.author, upscale_object)
+    if check is not None:
+        await ctx.send_response(content=settings.queue_refusal(check), ephemeral=True)
+        return
+    queue_position = queuehandler.submit(upscale_object)
+    await ctx.send_response(
+        f'<@{ctx.author.id}>, upscaling {message}by ``{resize}``x using ``{upscaler_1}``!\n'
+        f'Queue: ``{queue_position}``', delete_after=45.0)
         
 async def batch_download(ctx, message: discord.Message):
     # look for batch information in message
@@ -292,10 +351,10 @@ async def batch_download(ctx, message: discord.Message):
         else:
             image_ids.append(int(id))
 
-    # Find files corresponding to each image ID
+    # Find files corresponding to each image ID, once any that are still being saved are done
+    image_paths = await outputhandler.batch_files(settings.global_var.dir, batch_id, image_ids)
     files = []
-    for id_num in image_ids:
-        image_path = f'{settings.global_var.dir}/{batch_id}-{id_num}.png'
+    for id_num, image_path in zip(image_ids, image_paths):
         try:
             file = discord.File(image_path, f'{batch_id}-{id_num}.png')
             files.append(file)
@@ -314,3 +373,5 @@ async def batch_download(ctx, message: discord.Message):
     else:
         await ctx.respond(f'<@{ctx.author.id}>, The requested image ids were not found.')
 
+
+info_cache = InfoCache()
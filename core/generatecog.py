@@ -1,3 +1,4 @@
+import asyncio
 import os
 import discord
 import traceback
@@ -10,6 +11,7 @@ from typing import Optional
 
 from core import queuehandler
 from core import settings
+from core import statshandler
 
 
 class GenerateCog(commands.Cog):
@@ -31,12 +33,9 @@ class GenerateCog(commands.Cog):
                             prompt: Optional[str]):
 
         # set up the queue
-        if queuehandler.GlobalQueue.generate_thread.is_alive():
-            queuehandler.GlobalQueue.generate_queue.append(queuehandler.GenerateObject(self, ctx, prompt))
-        else:
-            await queuehandler.process_generate(self, queuehandler.GenerateObject(self, ctx, prompt))
+        queue_position = queuehandler.submit(queuehandler.GenerateObject(self, ctx, prompt))
 
-        await ctx.send_response(f"<@{ctx.author.id}>, {settings.messages()}\nQueue: ``{len(queuehandler.GlobalQueue.generate_queue)}`` - Your text: ``{prompt}``")
+        await ctx.send_response(f"<@{ctx.author.id}>, {settings.messages()}\nQueue: ``{queue_position}`` - Your text: ``{prompt}``")
 
     def post(self, event_loop: AbstractEventLoop, post_queue_object: queuehandler.PostObject):
         event_loop.create_task(
@@ -46,8 +45,6 @@ class GenerateCog(commands.Cog):
                 view=None
             )
         )
-        if queuehandler.GlobalQueue.post_queue:
-            self.post(event_loop, queuehandler.GlobalQueue.post_queue.pop(0))
 
     def dream(self, event_loop: AbstractEventLoop, queue_object: queuehandler.GenerateObject):
         try:
@@ -62,14 +59,11 @@ class GenerateCog(commands.Cog):
             queuehandler.process_post(
                 self, queuehandler.PostObject(
                     self, queue_object.ctx, content=f'<@{queue_object.ctx.author.id}>', file='', embed=embed, view=None))
+            statshandler.stats.record('generate', queue_object.ctx.author.id)
 
         except Exception as e:
             embed = discord.Embed(title='Generation failed', description=f'{e}\n{traceback.print_exc()}', color=0x00ff00)
-            event_loop.create_task(queue_object.ctx.channel.send(embed=embed))
-
-        # check each queue for any remaining tasks
-        if queuehandler.GlobalQueue.generate_queue:
-            event_loop.create_task(queuehandler.process_generate(self, queuehandler.GlobalQueue.generate_queue.pop(0)))
+            asyncio.run_coroutine_threadsafe(queue_object.ctx.channel.send(embed=embed), event_loop)
 
 
 def setup(bot):
@@ -1,17 +1,17 @@
 import base64
 import discord
 import traceback
-import requests
 from asyncio import AbstractEventLoop
 from discord import option
 from discord.ext import commands
-from threading import Thread
 from typing import Optional
 
+from core import backendhandler
 from core import ctxmenuhandler
 from core import queuehandler
 from core import viewhandler
 from core import settings
+from core import statshandler
 
 
 class IdentifyCog(commands.Cog):
@@ -51,7 +51,7 @@ class IdentifyCog(commands.Cog):
         # url *will* override init image for compatibility, can be changed here
         if init_url:
             try:
-                init_image = requests.get(init_url)
+                init_image = backendhandler.RemoteImage(init_url, await backendhandler.pool.download(init_url))
             except(Exception,):
                 await ctx.send_response('URL image not found!\nI have nothing to work with...', ephemeral=True)
                 has_image = False
@@ -75,17 +75,14 @@ class IdentifyCog(commands.Cog):
         input_tuple = (ctx, init_image.url, phrasing)
         view = viewhandler.DeleteView(input_tuple)
         # set up the queue if an image was found
-        user_queue_limit = settings.queue_check(ctx.author)
         if has_image:
-            if queuehandler.GlobalQueue.dream_thread.is_alive():
-                if user_queue_limit == "Stop":
-                    await ctx.send_response(content=f"Please wait! You're past your queue limit of {settings.global_var.queue_limit}.", ephemeral=True)
-                else:
-                    queuehandler.GlobalQueue.queue.append(queuehandler.IdentifyObject(self, *input_tuple, view))
-            else:
-                await queuehandler.process_dream(self, queuehandler.IdentifyObject(self, *input_tuple, view))
-            if user_queue_limit != "Stop":
-                await ctx.send_response(f"<@{ctx.author.id}>, I'm identifying the image!\nQueue: ``{len(queuehandler.GlobalQueue.queue)}``", delete_after=45.0)
+            identify_object = queuehandler.IdentifyObject(self, *input_tuple, view)
+            check = settings.queue_check(ctx.author, identify_object)
+            if check is not None:
+                await ctx.send_response(content=settings.queue_refusal(check), ephemeral=True)
+                return
+            queue_position = queuehandler.submit(identify_object)
+            await ctx.send_response(f"<@{ctx.author.id}>, I'm identifying the image!\nQueue: ``{queue_position}``", delete_after=45.0)
 
     # the function to queue Discord posts
     def post(self, event_loop: AbstractEventLoop, post_queue_object: queuehandler.PostObject):
@@ -96,21 +93,19 @@ class IdentifyCog(commands.Cog):
                 view=post_queue_object.view
             )
         )
-        if queuehandler.GlobalQueue.post_queue:
-            self.post(self.event_loop, self.queue.pop(0))
 
-    def dream(self, event_loop: AbstractEventLoop, queue_object: queuehandler.IdentifyObject):
+    async def dream(self, event_loop: AbstractEventLoop, queue_object: queuehandler.IdentifyObject):
         try:
             # construct a payload
-            image = base64.b64encode(requests.get(queue_object.init_image, stream=True).content).decode('utf-8')
+            image = base64.b64encode(await backendhandler.read_image(queue_object.init_image)).decode('utf-8')
             payload = {
                 "image": 'data:image/png;base64,' + image,
                 "model": queue_object.phrasing
             }
             # send normal payload to webui
-            s = settings.authenticate_user()
+            client = settings.authenticate_client(queue_object.backend)
 
-            response = s.post(url=f'{settings.global_var.url}/sdapi/v1/interrogate', json=payload)
+            response = await client.interrogate(payload)
             response_data = response.json()
 
             # post to discord
@@ -131,14 +126,13 @@ class IdentifyCog(commands.Cog):
                 queuehandler.process_post(
                     self, queuehandler.PostObject(
                         self, queue_object.ctx, content=f'<@{queue_object.ctx.author.id}>', file='', embed=embed, view=queue_object.view))
-            Thread(target=post_dream, daemon=True).start()
+                statshandler.stats.record('identify', queue_object.ctx.author.id)
+            post_dream()
 
         except Exception as e:
             embed = discord.Embed(title='identify failed', description=f'{e}\n{traceback.print_exc()}',
                                   color=settings.global_var.embed_color)
-            event_loop.create_task(queue_object.ctx.channel.send(embed=embed))
-        # check each queue for any remaining tasks
-        queuehandler.process_queue()
+            await queue_object.ctx.channel.send(embed=embed)
 
 
 def setup(bot):
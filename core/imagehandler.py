@@ -0,0 +1,392 @@
+import asyncio
+import io
+import multiprocessing
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from PIL import Image, PngImagePlugin
+
+from core import backendhandler
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# how much of a file to ask for at a time, the text chunks are usually within the first few KB
+WINDOW = 64 * 1024
+
+
+# reads a file at a URL front to back, only asking for the bytes that are needed when the server allows it
+class RemoteReader:
+    def __init__(self, url):
+        self.url = url
+        self.offset = 0
+        self.response = None
+
+    async def open(self, size):
+        end = self.offset + max(WINDOW, size) - 1
+        response = await backendhandler.pool.downloads().get(self.url, headers={'Range': f'bytes={self.offset}-{end}'})
+        try:
+            # the range started past the end of the file
+            if response.status == 416:
+                raise EOFError(self.url)
+            response.raise_for_status()
+            # a server that doesn't do ranges sends the whole file, which is still only read as far as needed
+            if response.status == 200 and self.offset:
+                await response.content.readexactly(self.offset)
+        except asyncio.IncompleteReadError:
+            response.close()
+            raise EOFError(self.url)
+        except(Exception,):
+            response.close()
+            raise
+        self.response = response
+
+    async def read(self, size):
+        data = b''
+        while len(data) < size:
+            fresh = self.response is None
+            if fresh:
+                await self.open(size - len(data))
+            chunk = await self.response.content.read(size - len(data))
+            if chunk:
+                data += chunk
+                self.offset += len(chunk)
+                continue
+            ranged = self.response.status == 206
+            self.close()
+            # a range that ran out means asking for the next one, anything else means the file ended
+            if fresh or not ranged:
+                raise EOFError(self.url)
+        return data
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+            self.response = None
+
+
+def decode_text_chunk(chunk_type, body):
+    keyword, _, rest = body.partition(b'\0')
+    if chunk_type == b'tEXt':
+        text = rest.decode('latin-1')
+    elif chunk_type == b'zTXt':
+        text = zlib.decompress(rest[1:]).decode('latin-1')
+    else:
+        # iTXt has a compression flag and method, then a language tag and translated keyword before the text
+        compressed = rest[0]
+        _, _, rest = rest[2:].partition(b'\0')
+        _, _, rest = rest.partition(b'\0')
+        text = (zlib.decompress(rest) if compressed else rest).decode('utf-8')
+    return keyword.decode('latin-1'), text
+
+
+# the text chunks of a PNG, which all come before the image data. None if it isn't a PNG
+async def read_text_chunks(reader):
+    try:
+        if await reader.read(8) != PNG_SIGNATURE:
+            return None
+        texts = {}
+        while True:
+            length, chunk_type = struct.unpack('>I4s', await reader.read(8))
+            if chunk_type in (b'IDAT', b'IEND'):
+                return texts
+            # the body and its CRC
+            body = (await reader.read(length + 4))[:length]
+            if chunk_type in (b'tEXt', b'zTXt', b'iTXt'):
+                keyword, text = decode_text_chunk(chunk_type, body)
+                texts[keyword] = text
+    finally:
+        reader.close()
+
+
+# the keywords of the text chunks in PNG bytes that are already in memory
+def text_keywords(data):
+    keywords = []
+    offset = len(PNG_SIGNATURE)
+    while offset + 8 <= len(data):
+        length, chunk_type = struct.unpack('>I4s', data[offset:offset + 8])
+        if chunk_type in (b'IDAT', b'IEND'):
+            break
+        if chunk_type in (b'tEXt', b'zTXt', b'iTXt'):
+            keywords.append(data[offset + 8:offset + 8 + length].partition(b'\0')[0])
+        offset += length + 12
+    return keywords
+
+
+def make_chunk(chunk_type, body):
+    return struct.pack('>I', len(body)) + chunk_type + body + struct.pack('>I', zlib.crc32(chunk_type + body))
+
+
+# add the parameters to PNG bytes as they are, without decoding and compressing the image all over again
+def with_parameters(data, parameters):
+    if not data.startswith(PNG_SIGNATURE) or not parameters:
+        return data
+    if b'parameters' in text_keywords(data):
+        return data
+    try:
+        chunk = make_chunk(b'tEXt', b'parameters\0' + parameters.encode('latin-1'))
+    except UnicodeEncodeError:
+        # tEXt can only hold latin-1, so anything else goes in an uncompressed iTXt with no language tag
+        chunk = make_chunk(b'iTXt', b'parameters\0\0\0\0\0' + parameters.encode('utf-8'))
+    # the header chunk always comes first and is always 13 bytes long
+    end = len(PNG_SIGNATURE) + 25
+    return data[:end] + chunk + data[end:]
+
+
+# the generation parameters written into an image, None if it isn't a PNG
+async def read_parameters(url):
+    texts = await read_text_chunks(RemoteReader(url))
+    if texts is None:
+        return None
+    return texts.get('parameters', '')
+
+
+# grids can be decoded, pasted and encoded in other processes, so big batches don't hold the GIL with the gateway
+class ImagePool:
+    def __init__(self):
+        self.executor = None
+        self.processes = 0
+        # the most bytes of pixels one grid can take up, 0 for no limit
+        self.memory_limit = 0
+        self.started = False
+
+    # only the first call does anything, later ones would fork a bot that already has threads
+    def start(self, processes):
+        if self.started:
+            return
+        self.started = True
+        if processes < 1:
+            return
+        # the bot's startup runs at the top of aiya.py, so processes that import it again aren't an option
+        try:
+            context = multiprocessing.get_context('fork')
+        except ValueError:
+            print("Image processes need fork, which isn't available here. Grids will be made in threads instead.")
+            return
+        # started before the fork so the processes use it instead of each starting their own
+        resource_tracker.ensure_running()
+        self.executor = ProcessPoolExecutor(max_workers=processes, mp_context=context)
+        self.processes = processes
+        # the processes are made now, before the bot has started any threads of its own
+        self.executor.submit(int).result()
+
+    # run image work in one of the processes, or right here when there aren't any
+    def run(self, func, *args):
+        if self.executor is None:
+            return func(*args)
+        return self.executor.submit(func, *args).result()
+
+
+def encode_png(image, parameters):
+    metadata = PngImagePlugin.PngInfo()
+    metadata.add_text("parameters", parameters)
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG', pnginfo=metadata)
+    return buffer.getvalue()
+
+
+# WebP and JPEG keep the parameters in the EXIF user comment, where the Web UI's png-info looks for them
+def exif_parameters(parameters):
+    exif = Image.Exif()
+    exif.get_ifd(0x8769)[0x9286] = b'UNICODE\0' + parameters.encode('utf-16-be')
+    return exif.tobytes()
+
+
+# the image in the format it's posted in, and the file extension for it. anything over the size limit is
+# made into a WebP, then given a lower quality and made smaller until it fits
+def encode_image(image, parameters, image_format='PNG', size_limit=0):
+    if image_format == 'PNG':
+        data = encode_png(image, parameters)
+        if not size_limit or len(data) <= size_limit:
+            return data, 'png'
+        image_format = 'WEBP'
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    exif = exif_parameters(parameters)
+    while True:
+        for quality in (90, 80, 70, 60):
+            buffer = io.BytesIO()
+            image.save(buffer, image_format, quality=quality, exif=exif)
+            if not size_limit or buffer.tell() <= size_limit:
+                return buffer.getvalue(), image_format.lower().replace('jpeg', 'jpg')
+        if min(image.size) <= 64:
+            return buffer.getvalue(), image_format.lower().replace('jpeg', 'jpg')
+        image = image.resize((max(image.width * 3 // 4, 1), max(image.height * 3 // 4, 1)))
+
+
+# whether a PNG from the Web UI can be posted just as it is
+def keeps_png(png_bytes, image_format='PNG', size_limit=0):
+    return image_format == 'PNG' and (not size_limit or len(png_bytes) <= size_limit)
+
+
+# a PNG from the Web UI as it's posted, it's only decoded when it has to change
+def encode_preview(png_bytes, parameters, image_format='PNG', size_limit=0):
+    if keeps_png(png_bytes, image_format, size_limit):
+        return png_bytes, 'png'
+    return encode_image(Image.open(io.BytesIO(png_bytes)), parameters, image_format, size_limit)
+
+
+# the image processes share the bot's resource tracker, which already has the name from when it was made.
+# unregistering it here would take it off for the bot too, so it's left for the bot to unregister when it unlinks
+def attach(name):
+    return SharedMemory(name=name)
+
+
+# a tile that isn't the size of its cell is resized to fit, same for every tile when the grid is scaled down
+def fit(tile, size):
+    if tile.mode != 'RGB':
+        tile = tile.convert('RGB')
+    if tile.size != size:
+        tile = tile.resize(size)
+    return tile
+
+
+# decode one tile straight into the grid's shared pixels
+def paste_tile(name, grid_size, tile_size, x, y, png_bytes):
+    shared = attach(name)
+    try:
+        pixels = fit(Image.open(io.BytesIO(png_bytes)), tile_size).tobytes()
+        stride = grid_size[0] * 3
+        line = tile_size[0] * 3
+        start = y * tile_size[1] * stride + x * line
+        for row in range(tile_size[1]):
+            offset = start + row * stride
+            shared.buf[offset:offset + line] = pixels[row * line:(row + 1) * line]
+    finally:
+        shared.close()
+
+
+# the image data of PNG bytes, from all of its IDAT chunks
+def idat_data(data):
+    parts = []
+    offset = len(PNG_SIGNATURE)
+    while offset + 8 <= len(data):
+        length, chunk_type = struct.unpack('>I4s', data[offset:offset + 8])
+        if chunk_type == b'IDAT':
+            parts.append(data[offset + 8:offset + 8 + length])
+        offset += length + 12
+    return b''.join(parts)
+
+
+# the checksum of two pieces of data put together, from the checksums of each, like zlib's adler32_combine
+def adler32_combine(first, second, second_length):
+    base = 65521
+    remainder = second_length % base
+    low = ((first & 0xffff) + (second & 0xffff) + base - 1) % base
+    high = (remainder * (first & 0xffff) + (first >> 16) + (second >> 16) + base - remainder) % base
+    return low | (high << 16)
+
+
+# one band of a grid's rows, filtered by PIL and compressed on its own so the bands can all be compressed at once.
+# every band but the last ends on a full flush, which lets them be joined into one stream
+def deflate_band(name, grid_size, top, bottom, last):
+    shared = attach(name)
+    try:
+        stride = grid_size[0] * 3
+        pixels = bytes(shared.buf[top * stride:bottom * stride])
+    finally:
+        shared.close()
+    # PIL still picks a filter for each row when it doesn't compress, the rows are taken back out of it
+    buffer = io.BytesIO()
+    Image.frombytes('RGB', (grid_size[0], bottom - top), pixels).save(buffer, 'PNG', compress_level=0)
+    filtered = zlib.decompress(idat_data(buffer.getvalue()))
+    # the first row can't be filtered against the row above it, that row is in another band
+    filtered = b'\0' + pixels[:stride] + filtered[stride + 1:]
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(filtered) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_FULL_FLUSH)
+    return data, zlib.adler32(filtered), len(filtered)
+
+
+def encode_shared(name, grid_size, parameters, image_format, size_limit):
+    shared = attach(name)
+    try:
+        return encode_image(Image.frombytes('RGB', grid_size, bytes(shared.buf)), parameters, image_format, size_limit)
+    finally:
+        shared.close()
+
+
+# fills in a grid one PNG tile at a time, so the tiles don't all have to be kept until the grid is made.
+# in the image processes when there are some
+class GridBuilder:
+    def __init__(self, count, cols, rows, tile_size, parameters):
+        self.count = count
+        self.cols = cols
+        self.added = 0
+        self.parameters = parameters
+        # a grid bigger than the memory limit has its tiles scaled down until it fits, which lowers the resolution
+        # of the posted grid only. grid_memory_limit in the config says so
+        scale = 1.0
+        grid_bytes = cols * tile_size[0] * rows * tile_size[1] * 3
+        if image_pool.memory_limit and grid_bytes > image_pool.memory_limit:
+            scale = (image_pool.memory_limit / grid_bytes) ** 0.5
+        self.tile_size = (max(int(tile_size[0] * scale), 1), max(int(tile_size[1] * scale), 1))
+        self.grid_size = (cols * self.tile_size[0], rows * self.tile_size[1])
+
+        self.executor = image_pool.executor
+        self.grid = None
+        self.shared = None
+        self.futures = []
+        if self.executor is None:
+            self.grid = Image.new('RGB', self.grid_size)
+        else:
+            # shared memory starts out zeroed, which leaves any empty tiles black like a new image would
+            self.shared = SharedMemory(create=True, size=self.grid_size[0] * self.grid_size[1] * 3)
+
+    # True once the grid has all of its tiles
+    def add(self, png_bytes):
+        y, x = divmod(self.added, self.cols)
+        self.added += 1
+        if self.executor is None:
+            tile = fit(Image.open(io.BytesIO(png_bytes)), self.tile_size)
+            self.grid.paste(tile, (x * self.tile_size[0], y * self.tile_size[1]))
+        else:
+            self.futures.append(self.executor.submit(paste_tile, self.shared.name, self.grid_size, self.tile_size,
+                                                     x, y, png_bytes))
+        return self.added >= self.count
+
+    # the encoded grid and its file extension, it can't be added to after this
+    def finish(self, image_format='PNG', size_limit=0):
+        try:
+            if self.executor is None:
+                return encode_image(self.grid, self.parameters, image_format, size_limit)
+            for future in self.futures:
+                future.result()
+            if image_format == 'PNG':
+                data = self.encode_png()
+                if not size_limit or len(data) <= size_limit:
+                    return data, 'png'
+                image_format = 'WEBP'
+            return self.executor.submit(encode_shared, self.shared.name, self.grid_size, self.parameters,
+                                        image_format, size_limit).result()
+        finally:
+            self.close()
+
+    # a PNG is compressed a band at a time across all the image processes, instead of all in one
+    def encode_png(self):
+        width, height = self.grid_size
+        bands = min(image_pool.processes * 2, height)
+        edges = [height * x // bands for x in range(bands + 1)]
+        futures = [self.executor.submit(deflate_band, self.shared.name, self.grid_size, edges[x], edges[x + 1],
+                                        x == bands - 1) for x in range(bands)]
+        parts = []
+        checksum = 1
+        for future in futures:
+            data, band_checksum, length = future.result()
+            parts.append(data)
+            checksum = adler32_combine(checksum, band_checksum, length)
+        stream = b'\x78\x9c' + b''.join(parts) + struct.pack('>I', checksum)
+        png = (PNG_SIGNATURE + make_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+               + make_chunk(b'IDAT', stream) + make_chunk(b'IEND', b''))
+        return with_parameters(png, self.parameters)
+
+    def close(self):
+        self.grid = None
+        self.futures = []
+        if self.shared is not None:
+            self.shared.close()
+            self.shared.unlink()
+            self.shared = None
+
+
+image_pool = ImagePool()
+
@@ -6,6 +6,7 @@ from discord.ext import commands
 from discord.ui import View
 from typing import Optional
 
+from core import outputhandler
 from core import settings
 from core import viewhandler
 
@@ -412,10 +413,10 @@ class InfoCog(commands.Cog):
                 else:
                     image_ids.append(int(id))
 
-            # Find files corresponding to each image ID
+            # Find files corresponding to each image ID, once any that are still being saved are done
+            image_paths = await outputhandler.batch_files(settings.global_var.dir, batch_id, image_ids)
             files = []
-            for id_num in image_ids:
-                image_path = f'{settings.global_var.dir}/{batch_id}-{id_num}.png'
+            for id_num, image_path in zip(image_ids, image_paths):
                 try:
                     file = discord.File(image_path, f'{batch_id}-{id_num}.png')
                     files.append(file)
@@ -0,0 +1,134 @@
+import inspect
+import json
+import sqlite3
+import threading
+import time
+
+from core import queuehandler
+from core import settings
+from core import viewhandler
+
+
+# stands in for the Discord context of a job that was queued before a restart
+class StoredContext:
+    def __init__(self, channel, author):
+        self.channel = channel
+        self.author = author
+        self.guild = getattr(channel, 'guild', None)
+
+
+# stands in for an attachment, only the URL is kept
+class StoredImage:
+    def __init__(self, url):
+        self.url = url
+
+
+# jobs are written down when they're queued and crossed off when they're done, so a restart can pick them up again
+class Journal:
+    def __init__(self):
+        self.connection = None
+        self.lock = threading.Lock()
+        self.replayed = False
+
+    def open(self, file_path):
+        if self.connection is not None:
+            return
+        self.connection = sqlite3.connect(file_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, '
+                                'cog TEXT, channel_id INTEGER, user_id INTEGER, params TEXT, queued REAL)')
+
+    def add(self, queue_object):
+        # jobs picked up after a restart already have their entry
+        if getattr(queue_object, 'journal_id', None) is not None:
+            return
+        try:
+            row = (type(queue_object).__name__, queue_object.cog.qualified_name, queue_object.ctx.channel.id,
+                   queue_object.ctx.author.id, json.dumps(serialize(queue_object)), time.time())
+            with self.lock:
+                cursor = self.connection.execute('INSERT INTO jobs (kind, cog, channel_id, user_id, params, queued) '
+                                                 'VALUES (?, ?, ?, ?, ?, ?)', row)
+            queue_object.journal_id = cursor.lastrowid
+        except Exception as e:
+            print(f"Couldn't write a job to the queue journal: {e}")
+
+    def done(self, queue_object):
+        jobs = [queue_object] + getattr(queue_object, 'merged', [])
+        ids = [(x.journal_id,) for x in jobs if getattr(x, 'journal_id', None) is not None]
+        if ids:
+            with self.lock:
+                self.connection.executemany('DELETE FROM jobs WHERE id = ?', ids)
+
+    def forget(self, job_id):
+        with self.lock:
+            self.connection.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+    def pending(self):
+        with self.lock:
+            return self.connection.execute('SELECT id, kind, cog, channel_id, user_id, params FROM jobs ORDER BY id').fetchall()
+
+
+# the parameters of a queue object, everything besides the cog, context and view
+def fields(kind):
+    parameters = inspect.signature(getattr(queuehandler, kind).__init__).parameters
+    return [x for x in parameters if x not in ('self', 'cog', 'ctx', 'view')]
+
+
+def serialize(queue_object):
+    params = {}
+    for name in fields(type(queue_object).__name__):
+        value = getattr(queue_object, name)
+        # attachments and downloaded URL images are kept as just the URL
+        if hasattr(value, 'url'):
+            value = {'url': value.url}
+        params[name] = value
+    return params
+
+
+def rebuild(kind, cog, ctx, params):
+    values = []
+    for name in fields(kind):
+        value = params[name]
+        if isinstance(value, dict) and 'url' in value:
+            value = StoredImage(value['url'])
+        values.append(value)
+    input_tuple = (ctx, *values)
+
+    queue_class = getattr(queuehandler, kind)
+    if queue_class is queuehandler.GenerateObject:
+        return queue_class(cog, *input_tuple)
+    if queue_class is queuehandler.DrawObject:
+        return queue_class(cog, *input_tuple, viewhandler.DrawView(input_tuple))
+    return queue_class(cog, *input_tuple, viewhandler.DeleteView(input_tuple))
+
+
+# put anything that was still waiting or running when the bot stopped back into the queue, only once per run
+async def resume(bot):
+    if settings.global_var.persist_queue != 'True' or journal.replayed:
+        return
+    journal.open(f'{settings.path}queue.db')
+    journal.replayed = True
+    queuehandler.GlobalQueue.scheduler.journal = journal
+
+    resumed = 0
+    for job_id, kind, cog_name, channel_id, user_id, params in journal.pending():
+        try:
+            cog = bot.get_cog(cog_name)
+            if cog is None:
+                raise LookupError(f'{cog_name} is not loaded')
+            channel = bot.get_channel(channel_id) or await bot.fetch_channel(channel_id)
+            author = bot.get_user(user_id) or await bot.fetch_user(user_id)
+            queue_object = rebuild(kind, cog, StoredContext(channel, author), json.loads(params))
+        except Exception as e:
+            print(f"Couldn't pick up job {job_id} from before the restart: {e}")
+            journal.forget(job_id)
+            continue
+        queue_object.journal_id = job_id
+        queuehandler.submit(queue_object)
+        resumed += 1
+    if resumed:
+        print(f'Picked up {resumed} queued jobs from before the restart.')
+
+
+journal = Journal()
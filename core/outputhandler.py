@@ -0,0 +1,171 @@
+import asyncio
+import atexit
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+
+# a catalogue of every output that's saved, so batches can be looked up without going through the folder
+class OutputIndex:
+    def __init__(self):
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def open(self, file_path):
+        if self.connection is not None:
+            return
+        self.connection = sqlite3.connect(file_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS outputs (path TEXT PRIMARY KEY, batch_id TEXT, '
+                                'image_id INTEGER, user_id INTEGER, channel_id INTEGER, prompt TEXT, model TEXT, '
+                                'seed INTEGER, width INTEGER, height INTEGER, bytes INTEGER, created REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS outputs_batch ON outputs (batch_id, image_id)')
+
+    # entries are added when an output is handed over to be saved, and forgotten if saving it fails
+    def add(self, file_path, entry, size):
+        if self.connection is None:
+            return
+        row = (file_path, entry.get('batch_id'), entry.get('image_id'), entry.get('user_id'), entry.get('channel_id'),
+               entry.get('prompt'), entry.get('model'), entry.get('seed'), entry.get('width'), entry.get('height'),
+               size, time.time())
+        try:
+            with self.lock:
+                self.connection.execute('INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+        except Exception as e:
+            print(f"Couldn't add {file_path} to the output index: {e}")
+
+    def forget(self, file_path):
+        if self.connection is None:
+            return
+        with self.lock:
+            self.connection.execute('DELETE FROM outputs WHERE path = ?', (file_path,))
+
+    # the path of each image of a batch that's been saved, by image ID
+    def find(self, batch_id, image_ids):
+        if self.connection is None:
+            return {}
+        with self.lock:
+            rows = self.connection.execute('SELECT image_id, path FROM outputs WHERE batch_id = ?', (batch_id,)).fetchall()
+        wanted = set(image_ids)
+        return {image_id: path for image_id, path in rows if image_id in wanted}
+
+
+# saves outputs in the background, so a slow disk doesn't hold up posting them
+class OutputWriter:
+    def __init__(self):
+        # how many threads save outputs, 0 saves them right away in the thread that asks
+        self.workers = 0
+        self.threads = []
+        self.queue = queue.Queue(maxsize=32)
+        # "none" leaves flushing to the system, "file" syncs each file, "full" also syncs the folder
+        self.fsync = 'none'
+        # the files that have been handed over but aren't on disk yet
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    # config is loaded again on refresh, so threads are only added or told to stop
+    def configure(self, workers, queue_size, fsync):
+        self.fsync = fsync
+        # the queue can't be swapped out from under threads that are using it
+        if not self.threads and queue_size != self.queue.maxsize:
+            self.queue = queue.Queue(maxsize=max(queue_size, 1))
+        self.workers = max(workers, 0)
+        self.threads = [x for x in self.threads if x.is_alive()]
+        # threads that aren't needed anymore stop once they get to the end of the queue
+        for _ in range(self.workers, len(self.threads)):
+            self.queue.put(None)
+        self.threads = self.threads[:self.workers]
+        for _ in range(len(self.threads), self.workers):
+            thread = threading.Thread(target=self.run, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    # waits for room when the queue is full, so outputs can't pile up in memory.
+    # the entry is what the output index keeps about it, besides its path and size
+    def write(self, file_path, data, entry=None):
+        if not self.workers:
+            index.add(file_path, entry or {}, len(data))
+            try:
+                self.save(file_path, data)
+            except(Exception,):
+                index.forget(file_path)
+                raise
+            return
+        # pending first, so anything that finds the file in the index also knows to wait for it
+        key = os.path.abspath(file_path)
+        with self.lock:
+            self.pending.setdefault(key, threading.Event())
+        index.add(file_path, entry or {}, len(data))
+        self.queue.put((file_path, data))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                file_path, data = item
+                try:
+                    self.save(file_path, data)
+                except Exception as e:
+                    print(f"Couldn't save {file_path}: {e}")
+                    index.forget(file_path)
+                finally:
+                    with self.lock:
+                        event = self.pending.pop(os.path.abspath(file_path), None)
+                    if event is not None:
+                        event.set()
+            finally:
+                self.queue.task_done()
+
+    # the file only shows up once it's complete
+    def save(self, file_path, data):
+        temp_path = f'{file_path}.part'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+            if self.fsync != 'none':
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temp_path, file_path)
+        if self.fsync == 'full' and hasattr(os, 'O_DIRECTORY'):
+            folder = os.open(os.path.dirname(os.path.abspath(file_path)), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(folder)
+            finally:
+                os.close(folder)
+        print(f'Saved image: {file_path}')
+
+    # block until these files are on disk, if they're still waiting to be saved
+    def wait(self, file_paths):
+        for file_path in file_paths:
+            with self.lock:
+                event = self.pending.get(os.path.abspath(file_path))
+            if event is not None:
+                event.wait()
+
+    async def settle(self, file_paths):
+        with self.lock:
+            waiting = any(os.path.abspath(x) in self.pending for x in file_paths)
+        if waiting:
+            await asyncio.get_running_loop().run_in_executor(None, self.wait, file_paths)
+
+    # let everything that's queued finish saving when the bot exits
+    def drain(self):
+        if self.threads:
+            self.queue.join()
+
+
+# the files of a batch's images once they're saved. anything saved before the index was kept has its usual name
+async def batch_files(folder, batch_id, image_ids):
+    found = index.find(batch_id, image_ids)
+    file_paths = [found.get(x, f'{folder}/{batch_id}-{x}.png') for x in image_ids]
+    await writer.settle(file_paths)
+    return file_paths
+
+
+index = OutputIndex()
+writer = OutputWriter()
+atexit.register(writer.drain)
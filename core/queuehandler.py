@@ -1,5 +1,13 @@
 import asyncio
-from threading import Thread
+import bisect
+import itertools
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from core import backendhandler
+from core import costhandler
 
 
 # the queue object for txt2image and img2img
@@ -29,6 +37,12 @@ class DrawObject:
         self.extra_net = extra_net
         self.epoch_time = epoch_time
         self.view = view
+        # only a draw that didn't ask for a seed can be given a different one
+        self.random_seed = False
+        # set when it was drawn together with others and given a seed other than the one it was queued with
+        self.reseeded = False
+        # other draws that will share this one's Web UI call
+        self.merged: list[DrawObject] = []
 
 
 # the queue object for extras - upscale
@@ -68,55 +82,318 @@ class GenerateObject:
 
 # the queue object for posting to Discord
 class PostObject:
-    def __init__(self, cog, ctx, content, file, embed, view):
+    def __init__(self, cog, ctx, content, file, embed, view, download_menu=False):
         self.cog = cog
         self.ctx = ctx
         self.content = content
         self.file = file
         self.embed = embed
         self.view = view
+        # the view gets a download menu when it's posted, views are only changed on the event loop
+        self.download_menu = download_menu
+
+
+# a lane is a line of waiting jobs served by its own fixed set of workers
+class Lane:
+    def __init__(self, name, workers=1, uses_backend=False, weight=1):
+        self.name = name
+        # 0 workers means one for each job the backends can take at once
+        self.workers = workers
+        self.uses_backend = uses_backend
+        # lanes waiting on a backend take turns, a lane with twice the weight gets twice the turns
+        self.weight = weight
+        self.pass_value = 0.0
+        self.jobs: deque[DrawObject | UpscaleObject | IdentifyObject | GenerateObject] = deque()
+        self.running = 0
+        self.running_cost = 0.0
+        self.wakeup = asyncio.Event()
+        # counters so fair ordering and queue limits never have to look through the jobs
+        self.virtual_time = 0.0
+        self.finish = {}
+        self.flows = {}
+        self.guild_users = {}
+        self.waiting = {}
+        self.cost = 0.0
+        self.user_cost = {}
+
+    def __len__(self):
+        return len(self.jobs)
+
+    # jobs are kept in order of a start tag. each guild gets its weight's share of the lane's GPU time, split between
+    # its users with jobs waiting, so a user's second job goes behind everyone else's first one
+    def add(self, queue_object, guild_weight):
+        user, guild = owner(queue_object)
+        flow = (guild, user)
+        if flow not in self.flows:
+            self.flows[flow] = 0
+            self.guild_users[guild] = self.guild_users.get(guild, 0) + 1
+        self.flows[flow] += 1
+        self.waiting[user] = self.waiting.get(user, 0) + 1
+        self.user_cost[user] = self.user_cost.get(user, 0.0) + queue_object.cost
+        self.cost += queue_object.cost
+
+        start = max(self.virtual_time, self.finish.get(flow, 0.0))
+        self.finish[flow] = start + queue_object.cost * self.guild_users[guild] / guild_weight
+        queue_object.tag = start
+        index = bisect.bisect_right(self.jobs, start, key=lambda x: x.tag)
+        self.jobs.insert(index, queue_object)
+        return index
+
+    def take(self, index=0):
+        queue_object = self.jobs[index]
+        del self.jobs[index]
+        user, guild = owner(queue_object)
+        flow = (guild, user)
+        self.virtual_time = max(self.virtual_time, queue_object.tag)
+
+        self.waiting[user] -= 1
+        self.user_cost[user] -= queue_object.cost
+        self.cost -= queue_object.cost
+        if self.waiting[user] == 0:
+            del self.waiting[user]
+            del self.user_cost[user]
+        self.flows[flow] -= 1
+        if self.flows[flow] == 0:
+            del self.flows[flow]
+            self.guild_users[guild] -= 1
+            if self.guild_users[guild] == 0:
+                del self.guild_users[guild]
+            # a user who just had a turn still waits out its share if they queue again right away
+            if self.finish[flow] <= self.virtual_time:
+                del self.finish[flow]
+        # with nothing left waiting there's no one to be fair to
+        if not self.jobs:
+            self.finish.clear()
+            self.cost = 0.0
+        return queue_object
+
+
+# long-lived workers on the bot's event loop take jobs from the lanes and run them in a thread pool
+class Scheduler:
+    def __init__(self):
+        self.lanes = {
+            'draw': Lane('Draw Queue', workers=0, uses_backend=True),
+            'light': Lane('Upscale/Identify Queue', uses_backend=True, weight=2),
+            'generate': Lane('/Generate Queue')
+        }
+        self.executor = None
+        self.workers = []
+        self.waiters = []
+        # when every backend with room is down, waiters are looked at again once one can be retried
+        self.retry_handle = None
+        self.virtual_time = 0.0
+        # how far ahead to look for a job that can use the loaded model, and how often a job can be passed over
+        self.affinity_window = 8
+        self.affinity_skips = 3
+        self.swaps_avoided = 0
+        # how many draws that only differ by seed can share one Web UI call
+        self.coalesce_limit = 1
+        # guild id -> share of each lane, guilds not listed get 1
+        self.guild_weights = {}
+        self.cost_model = costhandler.CostModel()
+        # where queued jobs are written down to survive a restart, if that's turned on
+        self.journal = None
+
+    # concurrency only takes effect on startup since that's when the workers are made
+    def configure_lane(self, name, workers, weight):
+        lane = self.lanes[name]
+        if not self.workers:
+            lane.workers = workers
+        lane.weight = max(float(weight), 0.1)
+
+    def lane_for(self, queue_object):
+        if isinstance(queue_object, GenerateObject):
+            return self.lanes['generate']
+        if isinstance(queue_object, DrawObject):
+            return self.lanes['draw']
+        return self.lanes['light']
+
+    # workers are started once, on the loop the bot is running on
+    def start(self):
+        if self.workers:
+            return
+        loop = asyncio.get_running_loop()
+        GlobalQueue.event_loop = loop
+        for lane in self.lanes.values():
+            if lane.workers < 1:
+                lane.workers = backendhandler.pool.capacity()
+        self.executor = ThreadPoolExecutor(max_workers=sum(lane.workers for lane in self.lanes.values()),
+                                           thread_name_prefix='dream')
+        for lane in self.lanes.values():
+            for _ in range(lane.workers):
+                self.workers.append(loop.create_task(self.work(lane)))
+
+    # returns how many jobs are ahead of this one, and sets its cost and roughly how long until it's done
+    def submit(self, queue_object):
+        self.start()
+        lane = self.lane_for(queue_object)
+        queue_object.cost = self.cost_model.estimate(queue_object)
+        if self.journal is not None:
+            self.journal.add(queue_object)
+        guild_weight = self.guild_weights.get(str(owner(queue_object)[1]), 1)
+        index = lane.add(queue_object, guild_weight)
+        # jobs that are running are about halfway done on average
+        ahead = sum(job.cost for job in itertools.islice(lane.jobs, index)) + lane.running_cost / 2
+        queue_object.eta = self.cost_model.seconds(ahead / max(lane.workers, 1) + queue_object.cost)
+        lane.wakeup.set()
+        return max(0, lane.running + index + 1 - lane.workers)
+
+    # how many jobs a user has waiting for a draw, upscale or identify
+    def waiting(self, user_id):
+        return self.lanes['draw'].waiting.get(user_id, 0) + self.lanes['light'].waiting.get(user_id, 0)
+
+    # the cost of the draws, upscales and identifies that are waiting, for one user or everyone
+    def waiting_cost(self, user_id=None):
+        if user_id is None:
+            return self.lanes['draw'].cost + self.lanes['light'].cost
+        return self.lanes['draw'].user_cost.get(user_id, 0.0) + self.lanes['light'].user_cost.get(user_id, 0.0)
 
+    # wait for a backend with room, sharing them between lanes by weight when more than one lane is waiting
+    async def acquire(self, lane: Lane):
+        # a lane that was idle doesn't get to catch up on the turns it didn't need
+        lane.pass_value = max(lane.pass_value, self.virtual_time)
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((lane, future))
+        self.dispatch()
+        return await future
 
-# any command that needs to wait on processing should use the dream thread
+    # the worker that freed the backend gets a chance to line up again before the next turn is given out
+    def release(self, backend: backendhandler.Backend):
+        backendhandler.pool.release(backend)
+        asyncio.get_running_loop().call_soon(self.dispatch)
+
+    def dispatch(self):
+        while self.waiters and backendhandler.pool.has_room():
+            waiter = min(self.waiters, key=lambda x: x[0].pass_value)
+            self.waiters.remove(waiter)
+            lane, future = waiter
+            if not future.cancelled():
+                self.charge(lane)
+                future.set_result(backendhandler.pool.acquire())
+        if self.waiters and self.retry_handle is None:
+            delay = backendhandler.pool.retry_delay()
+            if delay is not None:
+                self.retry_handle = asyncio.get_running_loop().call_later(delay, self.retry)
+
+    def retry(self):
+        self.retry_handle = None
+        self.dispatch()
+
+    def charge(self, lane: Lane):
+        self.virtual_time = lane.pass_value
+        lane.pass_value += 1 / lane.weight
+
+    # take the next job, preferring one that won't make the backend swap checkpoints
+    def pick(self, lane: Lane, backend: backendhandler.Backend | None):
+        head = lane.jobs[0]
+        if backend is None or backend.sd_model is None or not needs_swap(head, backend) \
+                or getattr(head, 'skips', 0) >= self.affinity_skips:
+            return lane.take()
+
+        for index in range(1, min(self.affinity_window, len(lane.jobs))):
+            if not needs_swap(lane.jobs[index], backend):
+                queue_object = lane.take(index)
+                # every job that was passed over gets closer to being forced through
+                for skipped in list(lane.jobs)[:index]:
+                    skipped.skips = getattr(skipped, 'skips', 0) + 1
+                self.swaps_avoided += 1
+                return queue_object
+        return lane.take()
+
+    # pull any waiting draws that can go in the same Web UI call as this one
+    def coalesce(self, lane: Lane, queue_object):
+        key = coalesce_key(queue_object)
+        if key is None or self.coalesce_limit <= 1:
+            return
+        matches = [index for index, job in enumerate(lane.jobs) if coalesce_key(job) == key]
+        matches = matches[:self.coalesce_limit - 1]
+        queue_object.merged = [lane.take(index) for index in reversed(matches)][::-1]
+
+    async def work(self, lane: Lane):
+        loop = asyncio.get_running_loop()
+        while True:
+            while not lane.jobs:
+                lane.wakeup.clear()
+                await lane.wakeup.wait()
+            backend = await self.acquire(lane) if lane.uses_backend else None
+            # another worker may have emptied the lane while this one waited for a backend
+            if not lane.jobs:
+                if backend is not None:
+                    self.release(backend)
+                continue
+            queue_object = self.pick(lane, backend)
+            queue_object.backend = backend
+            self.coalesce(lane, queue_object)
+            cost = queue_object.cost + sum(job.cost for job in queue_object.merged) \
+                if isinstance(queue_object, DrawObject) else queue_object.cost
+            # loading a checkpoint takes a while, so those runs don't say much about how long the job took
+            calibrate = backend is None or (backend.sd_model is not None and not needs_swap(queue_object, backend))
+            lane.running += 1
+            lane.running_cost += cost
+            start_time = time.time()
+            try:
+                if asyncio.iscoroutinefunction(queue_object.cog.dream):
+                    await queue_object.cog.dream(loop, queue_object)
+                else:
+                    await loop.run_in_executor(self.executor, queue_object.cog.dream, loop, queue_object)
+                if calibrate:
+                    self.cost_model.record(queue_object, time.time() - start_time)
+            except(Exception,):
+                traceback.print_exc()
+            finally:
+                lane.running -= 1
+                lane.running_cost -= cost
+                if self.journal is not None:
+                    self.journal.done(queue_object)
+                if backend is not None:
+                    self.release(backend)
+
+
+# any command that needs to wait on processing should go through the scheduler
 class GlobalQueue:
-    dream_thread = Thread()
-    post_event_loop = asyncio.get_event_loop()
-    queue: list[DrawObject | UpscaleObject | IdentifyObject] = []
-    # new generate queue and thread
-    generate_queue: list[GenerateObject] = []
-    generate_thread = Thread()
-    
-    post_thread = Thread()
     event_loop = asyncio.get_event_loop()
-    post_queue: list[PostObject] = []
-    
+    scheduler = Scheduler()
+    queue = scheduler.lanes['draw'].jobs
+    light_queue = scheduler.lanes['light'].jobs
+    generate_queue = scheduler.lanes['generate'].jobs
+
     def get_queue_sizes():
-        return {
-            "General Queue": len(GlobalQueue.queue),
-            "/Generate Queue": len(GlobalQueue.generate_queue)
-        }
+        return {lane.name: len(lane) for lane in GlobalQueue.scheduler.lanes.values()}
+
+
+# who a job counts against, the guild is None outside of servers
+def owner(queue_object):
+    guild = getattr(queue_object.ctx, 'guild', None)
+    return queue_object.ctx.author.id, guild.id if guild is not None else None
+
+
+# only draws with a data model set will post a checkpoint change
+def needs_swap(queue_object, backend: backendhandler.Backend):
+    return isinstance(queue_object, DrawObject) and queue_object.data_model != '' \
+        and queue_object.data_model != backend.sd_model
+
 
+# draws that only differ by seed can be generated as one batch
+def coalesce_key(queue_object):
+    # merged draws get the seeds that follow the first one's, so a seed someone asked for has to draw alone
+    if not isinstance(queue_object, DrawObject) or not queue_object.random_seed or queue_object.init_image is not None \
+            or queue_object.batch[0] != 1 or queue_object.batch[1] != 1:
+        return None
+    return (queue_object.prompt, queue_object.negative_prompt, queue_object.data_model, queue_object.steps,
+            queue_object.width, queue_object.height, str(queue_object.guidance_scale), queue_object.sampler,
+            queue_object.styles, queue_object.facefix, queue_object.highres_fix, queue_object.clip_skip,
+            str(queue_object.strength))
 
-def process_queue():
-    def start(target_queue: list[DrawObject | UpscaleObject | IdentifyObject | GenerateObject]):
-        queue_object = target_queue.pop(0)
-        queue_object.cog.dream(GlobalQueue.event_loop, queue_object)
 
-    if GlobalQueue.queue:
-        start(GlobalQueue.queue)
+def submit(queue_object: DrawObject | UpscaleObject | IdentifyObject | GenerateObject):
+    return GlobalQueue.scheduler.submit(queue_object)
 
 
-async def process_dream(self, queue_object: DrawObject | UpscaleObject | IdentifyObject):
-    GlobalQueue.dream_thread = Thread(target=self.dream, args=(GlobalQueue.event_loop, queue_object))
-    GlobalQueue.dream_thread.start()
+# image and disk work from jobs on the event loop goes to the thread pool so it doesn't hold up the bot
+async def run_blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(GlobalQueue.scheduler.executor, func, *args)
 
-async def process_generate(self, queue_object: GenerateObject):
-    GlobalQueue.generate_thread = Thread(target=self.dream, args=(GlobalQueue.event_loop, queue_object))
-    GlobalQueue.generate_thread.start()
 
+# posts are handed back to the event loop since jobs run in worker threads
 def process_post(self, queue_object: PostObject):
-    if GlobalQueue.post_thread.is_alive():
-        GlobalQueue.post_queue.append(queue_object)
-    else:
-        GlobalQueue.post_thread = Thread(target=self.post, args=(GlobalQueue.post_event_loop, queue_object))
-        GlobalQueue.post_thread.start()
+    GlobalQueue.event_loop.call_soon_threadsafe(self.post, GlobalQueue.event_loop, queue_object)
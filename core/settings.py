@@ -3,12 +3,20 @@ import discord
 import json
 import os
 import random
+import re
 import requests
+import sqlite3
 import time
+import threading
 import tomlkit
+from types import MappingProxyType, SimpleNamespace
 from typing import Optional
 
+from core import backendhandler
+from core import imagehandler
+from core import outputhandler
 from core import queuehandler
+from core import statshandler
 
 self = discord.Bot()
 dir_path = os.path.dirname(os.path.realpath(__file__))
@@ -20,6 +28,9 @@ default_config = """# This is the config file. It's advisable to restart if any
 
 # The URL address to the AUTOMATIC1111 Web UI
 url = "http://127.0.0.1:7860"
+# Any other Web UI instances to share the work with. A higher weight gets more of the jobs
+# example, [{url = "http://192.168.1.20:7860", weight = 2}, "http://192.168.1.21:7860"]
+backends = []
 
 # Credentials when using --share and --gradio-auth
 user = ""
@@ -37,6 +48,62 @@ dir = "outputs"
 
 # The limit of tasks a user can have waiting in queue (at least 1)
 queue_limit = 1
+# The limit of work a user can have waiting, in cost units, used instead of queue_limit (0 = use queue_limit)
+# A 512x512 image at 30 steps is about 30 units. A user with nothing waiting can always queue one task
+queue_cost_limit = 0
+# The most work that can be waiting in the queue from everyone together, in cost units (0 = no limit)
+queue_cost_max = 0
+# Jobs are shared out fairly between servers, and between users in a server. A server with a higher weight gets more turns
+# example, {"123456789012345678" = 2}
+guild_weights = {}
+
+# Whether or not queued jobs are kept on disk and picked up again after a restart ("True"/"False")
+persist_queue = "True"
+
+# How many seconds to wait for the Web UI to accept a connection, and to answer a request (0 = wait forever)
+connect_timeout = 10
+read_timeout = 600
+
+# How many processes put batch grids together, so big batches don't slow down the bot (0 = use threads)
+# Changes to this need a restart
+image_processes = 0
+# The most memory in MB one batch grid can take up while it's put together (0 = no limit)
+# A bigger grid is posted at a lower resolution, the drawings in it are still saved and downloaded at full size
+# A full 25 image grid of 1024x1024 drawings takes about 75 MB
+grid_memory_limit = 256
+# How drawings and batch grids are posted, "PNG" or a smaller "WEBP"/"JPEG" preview
+# The PNGs of previews are always saved, and can be fetched with the download menu under the image
+output_format = "PNG"
+# The most MB a posted image can be, bigger ones are posted as a WebP that's made smaller until it fits (0 = no limit)
+upload_size_limit = 8
+
+# How many threads save outputs in the background after they're posted (0 = save them before posting)
+output_writers = 2
+# How many outputs can be waiting to be saved before new ones wait for room. Changes to this need a restart
+output_queue_size = 32
+# How saved outputs are flushed to disk: "none" leaves it to the system, "file" syncs each file, "full" also syncs the folder
+output_fsync = "none"
+
+# How many seconds the stats are kept in memory between saves (0 = only save them on exit)
+stats_interval = 60
+
+# How many jobs each Web UI backend is given at once
+backend_jobs = 1
+# How many draws, and how many upscales/identifies, can be running at once (0 = as many as the backends can take)
+draw_concurrency = 0
+light_concurrency = 1
+# When draws and upscales/identifies are both waiting for a backend, how many turns each one gets
+draw_weight = 1
+light_weight = 2
+
+# How many queued jobs AIYA looks through for one using the model that's already loaded (1 to disable)
+model_affinity = 8
+# How many times a job can be passed over that way before it has to run next
+model_affinity_skips = 3
+
+# How many queued draws with the same prompt and settings can be drawn together in one batch (1 to disable)
+# Only draws with a random seed are put together, and their seeds will count up from the first one
+coalesce_draws = 1
 
 # Whether or not buttons keep generating in batches ("True"/"False")
 batch_buttons = "False"
@@ -50,6 +117,10 @@ max_size = 1024
 # The resize amount when using context menu Quick Upscale
 quick_upscale_resize = 2.0
 
+# How many images' info is kept for Get Image Info and the info button, and for how many seconds (0 = don't keep any)
+info_cache_size = 256
+info_cache_ttl = 3600
+
 # AIYA won't generate if prompt has any words in the ban list
 # Separate with commas; example, ["a", "b", "c"]
 prompt_ban_list = []
@@ -57,6 +128,8 @@ prompt_ban_list = []
 prompt_ignore_list = []
 # Choose whether or not ignored words are displayed to user
 display_ignored_words = "False"
+# Whether words in the ban and ignore lists only count as whole words, so "cat" doesn't match "category" ("True"/"False")
+prompt_match_words = "False"
 # These words will be added to the beginning of the negative prompt
 negative_prompt_prefix = []
 
@@ -92,7 +165,6 @@ class GlobalVar:
     wait_message = []
     wait_message_count = 0
     embed_color = discord.Colour.from_rgb(222, 89, 28)
-    gradio_auth = None
     username: Optional[str] = None
     password: Optional[str] = None
     api_auth = False
@@ -113,16 +185,136 @@ class GlobalVar:
     hires_upscaler_names = []
     save_outputs = "True"
     queue_limit = 1
+    queue_cost_limit = 0
+    queue_cost_max = 0
+    persist_queue = "True"
+    image_processes = 0
+    output_format = "PNG"
+    upload_size_limit = 8
     batch_buttons = "False"
     restrict_buttons = "True"
     quick_upscale_resize = 2.0
+    info_cache_size = 256
+    info_cache_ttl = 3600
+    # goes up every time the lists from the Web UI are loaded
+    catalog_version = 0
     prompt_ban_list = []
     prompt_ignore_list = []
+    # the lists above put together into one pattern each, None when a list is empty
+    prompt_ban_pattern = None
+    prompt_ignore_pattern = None
     display_ignored_words = "False"
     negative_prompt_prefix = []
 
 
+# the settings of each channel as they were last read, so a draw doesn't go to the store every time it needs one
+class SettingsCache:
+    def __init__(self):
+        self.entries = {}
+        # goes up for a channel every time AIYA writes its settings
+        self.versions = {}
+        self.lock = threading.Lock()
+        # only one write to a channel's settings at a time
+        self.write_lock = threading.Lock()
+
+    def version(self, channel_id):
+        with self.lock:
+            return self.versions.get(channel_id, 0)
+
+    # only if the channel hasn't been written since, and nothing else has changed the store
+    def get(self, channel_id, version, stamp):
+        with self.lock:
+            entry = self.entries.get(channel_id)
+        if entry is not None and entry[0] == (version, stamp):
+            return entry[1]
+        return None
+
+    def put(self, channel_id, version, stamp, settings):
+        with self.lock:
+            self.entries[channel_id] = ((version, stamp), settings)
+
+    def bump(self, channel_id):
+        with self.lock:
+            self.versions[channel_id] = self.versions.get(channel_id, 0) + 1
+            self.entries.pop(channel_id, None)
+
+    # the template changes when the config is loaded again
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+
+# the defaults of every channel, kept together in one table
+class ChannelStore:
+    def __init__(self):
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def open(self, file_path):
+        if self.connection is not None:
+            return
+        self.connection = sqlite3.connect(file_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS channels (channel_id TEXT PRIMARY KEY, settings TEXT, '
+                                'updated REAL)')
+        self.connection.execute("CREATE INDEX IF NOT EXISTS channels_model ON channels "
+                                "(json_extract(settings, '$.data_model'))")
+
+    # goes up when another connection changes the store, like someone editing it by hand while AIYA runs
+    def stamp(self):
+        with self.lock:
+            return self.connection.execute('PRAGMA data_version').fetchone()[0]
+
+    def load(self, channel_id):
+        with self.lock:
+            row = self.connection.execute('SELECT settings FROM channels WHERE channel_id = ?', (channel_id,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def save(self, channel_id, settings):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO channels VALUES (?, ?, ?)',
+                                    (channel_id, json.dumps(settings), time.time()))
+
+    # the models channels are set to, read straight from the data_model index
+    def models(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT DISTINCT json_extract(settings, '$.data_model') FROM channels "
+                                           "WHERE json_extract(settings, '$.data_model') IS NOT NULL").fetchall()
+        return [x[0] for x in rows]
+
+    # every channel set to this model
+    def find_model(self, model):
+        with self.lock:
+            rows = self.connection.execute("SELECT channel_id FROM channels WHERE json_extract(settings, '$.data_model') = ?",
+                                           (model,)).fetchall()
+        return [x[0] for x in rows]
+
+    # bring in the <channel_id>.json files from before, they're moved into a folder once they're in
+    def migrate(self, folder):
+        names = [x for x in os.listdir(folder) if x.endswith('.json') and x[:-5].isdigit()]
+        if not names:
+            return
+        os.makedirs(f'{folder}migrated', exist_ok=True)
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                for name in names:
+                    with open(f'{folder}{name}', 'r') as configfile:
+                        settings = json.load(configfile)
+                    self.connection.execute('INSERT OR IGNORE INTO channels VALUES (?, ?, ?)',
+                                            (name[:-5], json.dumps(settings), time.time()))
+                self.connection.execute('COMMIT')
+            except(Exception,):
+                self.connection.execute('ROLLBACK')
+                raise
+        for name in names:
+            os.replace(f'{folder}{name}', f'{folder}migrated/{name}')
+        print(f'Moved the settings of {len(names)} channels into {folder}channels.db.')
+
+
 global_var = GlobalVar()
+channel_cache = SettingsCache()
+channel_store = ChannelStore()
 
 
 def batch_format(batch_string):
@@ -146,20 +338,50 @@ def batch_format(batch_string):
     return count, size, values_given
 
 
+# a regex matching any of the words. they're put in a tree first so words that start the same share one branch,
+# and the prompt is only gone through once no matter how long the list is
+def word_pattern(words, ignore_case, whole_words):
+    trie = {}
+    for word in words:
+        word = str(word).lower()
+        # an empty word would match every prompt
+        if not word:
+            continue
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = True
+    if not trie:
+        return None
+
+    def branch(node):
+        end = '' in node
+        options = [re.escape(char) + branch(child) for char, child in sorted(node.items()) if char]
+        if not options:
+            return ''
+        if len(options) == 1 and not end:
+            return options[0]
+        # a word that ends here can also go on, the longer one is tried first
+        return '(?:' + '|'.join(options) + ')' + ('?' if end else '')
+
+    pattern = branch(trie)
+    if whole_words:
+        pattern = rf'(?<!\w)(?:{pattern})(?!\w)'
+    return re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+
+
 def prompt_mod(prompt, negative_prompt):
     clean_negative_prompt = negative_prompt
     # if any banned words are in prompt, return immediately
-    if global_var.prompt_ban_list:
-        for x in global_var.prompt_ban_list:
-            x = str(x.lower())
-            if x in prompt.lower():
-                return "Stop", x
+    if global_var.prompt_ban_pattern is not None:
+        match = global_var.prompt_ban_pattern.search(prompt)
+        if match:
+            return "Stop", match.group(0).lower()
     # otherwise mod the prompt/negative prompt
     if global_var.prompt_ignore_list or global_var.negative_prompt_prefix:
-        for y in global_var.prompt_ignore_list:
-            y = str(y.lower())
-            if y in prompt.lower():
-                prompt = prompt.replace(y, "")
+        # only the words as they're written in the list are taken out, which is how it's always worked
+        if global_var.prompt_ignore_pattern is not None:
+            prompt = global_var.prompt_ignore_pattern.sub('', prompt)
         prompt = ' '.join(prompt.split())
         if prompt == '':
             prompt = ' '
@@ -209,21 +431,25 @@ def extra_net_defaults(prompt, channel):
     return prompt
 
 
-def queue_check(author_compare):
-    user_queue = 0
-    for queue_object in queuehandler.GlobalQueue.queue:
-        if queue_object.ctx.author.id == author_compare.id:
-            user_queue += 1
-            if user_queue >= global_var.queue_limit:
-                return "Stop"
+def queue_check(author_compare, queue_object=None):
+    scheduler = queuehandler.GlobalQueue.scheduler
+    cost = scheduler.cost_model.estimate(queue_object) if queue_object is not None else 0
+    if global_var.queue_cost_max and scheduler.waiting_cost() + cost > global_var.queue_cost_max:
+        return "Full"
+    if global_var.queue_cost_limit:
+        user_cost = scheduler.waiting_cost(author_compare.id)
+        if user_cost and user_cost + cost > global_var.queue_cost_limit:
+            return "Stop"
+    elif scheduler.waiting(author_compare.id) >= global_var.queue_limit:
+        return "Stop"
 
 
-def stats_count(number):
-    with open(f'{path}stats.txt', 'r') as f:
-        data = list(map(float, f.readlines()))
-    data[0] += number
-    with open(f'{path}stats.txt', 'w') as f:
-        f.write('\n'.join(str(int(x)) for x in data))
+def queue_refusal(check):
+    if check == "Full":
+        return "The queue is full right now! Please try again in a little while."
+    if global_var.queue_cost_limit:
+        return f"Please wait! You're past your queue limit of {global_var.queue_cost_limit} cost units."
+    return f"Please wait! You're past your queue limit of {global_var.queue_limit}."
 
 
 def messages():
@@ -234,9 +460,9 @@ def messages():
 def check(channel_id):
     try:
         read(str(channel_id))
-    except FileNotFoundError:
+    except LookupError:
         build(str(channel_id))
-        print(f'This is a new channel!? Creating default settings file for this channel ({channel_id}).')
+        print(f'This is a new channel!? Creating default settings for this channel ({channel_id}).')
         # if models.csv has the blank "Default" data, update default settings
         with open(f'{path}models.csv', 'r', encoding='utf-8') as f:
             reader = csv.DictReader(f, delimiter='|')
@@ -248,6 +474,7 @@ def check(channel_id):
 
 def config_auth(config):
     global_var.url = config['url']
+    backendhandler.pool.configure(config['url'], config['backends'])
     global_var.dir = config['dir']
     global_var.username = config['user']
     global_var.password = config['pass']
@@ -280,59 +507,89 @@ def generate_template(template_pop, config):
 
 
 def build(channel_id):
-    settings = json.dumps(template, indent=1)
-    with open(path + channel_id + '.json', 'w') as configfile:
-        configfile.write(settings)
+    write(channel_id, template)
 
 
-def read(channel_id):
-    with open(path + channel_id + '.json', 'r') as configfile:
-        settings = dict(template)
-        settings.update(json.load(configfile))
+# the whole row is replaced in one statement, so it's never left half-written
+def write(channel_id, settings):
+    channel_store.save(channel_id, settings)
+    channel_cache.bump(channel_id)
 
-        # update deprecated 'count' to 'batch'
-        if 'count' in settings or 'max_count' in settings:
-            try:
-                settings['batch'] = str(settings.pop('count'))
-                settings['max_batch'] = str(settings.pop('max_count'))
-            except(Exception,):
-                pass
-            with open(path + channel_id + '.json', 'w') as configfile2:
-                json.dump(settings, configfile2, indent=1)
 
+# a read-only snapshot, the store is only asked again when the channel changes
+def read(channel_id):
+    version = channel_cache.version(channel_id)
+    stamp = channel_store.stamp()
+    cached = channel_cache.get(channel_id, version, stamp)
+    if cached is not None:
+        return cached
+
+    stored = channel_store.load(channel_id)
+    if stored is None:
+        raise LookupError(f'No settings for channel {channel_id}')
+    settings = dict(template)
+    settings.update(stored)
+
+    # update deprecated 'count' to 'batch'
+    if 'count' in settings or 'max_count' in settings:
+        try:
+            settings['batch'] = str(settings.pop('count'))
+            settings['max_batch'] = str(settings.pop('max_count'))
+        except(Exception,):
+            pass
+        with channel_cache.write_lock:
+            write(channel_id, settings)
+        return MappingProxyType(settings)
+
+    settings = MappingProxyType(settings)
+    channel_cache.put(channel_id, version, stamp, settings)
     return settings
 
 
 def update(channel_id: str, sett: str, value):
-    with open(path + channel_id + '.json', 'r') as configfile:
-        settings = json.load(configfile)
-    settings[sett] = value
-    with open(path + channel_id + '.json', 'w') as configfile:
-        json.dump(settings, configfile, indent=1)
-
-
-def authenticate_user():
-    s = requests.Session()
-    if global_var.api_auth:
-        s.auth = (global_var.api_user, global_var.api_pass)
-
-    # do a check to see if --gradio-auth is set
-    if global_var.gradio_auth is None:
-        r = s.get(global_var.url + '/sdapi/v1/cmd-flags')
-        if r.status_code == 401:
-            global_var.gradio_auth = True
-        else:
-            global_var.gradio_auth = False
-
-    if global_var.gradio_auth:
+    update_many(channel_id, {sett: value})
+
+
+# apply several changes with one write, either all of them are saved or none are
+def update_many(channel_id: str, changes: dict):
+    with channel_cache.write_lock:
+        settings = channel_store.load(channel_id)
+        if settings is None:
+            raise LookupError(f'No settings for channel {channel_id}')
+        settings.update(changes)
+        write(channel_id, settings)
+
+
+# every backend keeps one session that logs in the first time it's needed
+def authenticate_user(backend: backendhandler.Backend = None):
+    if backend is None:
+        backend = backendhandler.pool.primary()
+    with backend.session_lock:
+        if backend.session is None:
+            login_payload = {
+                'username': global_var.username,
+                'password': global_var.password
+            }
+            s = backendhandler.BackendSession(backend, login_payload)
+            if global_var.api_auth:
+                s.auth = (global_var.api_user, global_var.api_pass)
+            s.login()
+            backend.session = s
+    return backend.session
+
+
+# jobs on the event loop get a client for each backend, it logs in on its first request
+def authenticate_client(backend: backendhandler.Backend = None):
+    if backend is None:
+        backend = backendhandler.pool.primary()
+    if backend.client is None:
         login_payload = {
             'username': global_var.username,
             'password': global_var.password
         }
-        s.post(global_var.url + '/login', data=login_payload)
-    else:
-        s.post(global_var.url + '/login')
-    return s
+        api_auth = (global_var.api_user, global_var.api_pass) if global_var.api_auth else None
+        backend.client = backendhandler.BackendClient(backend, login_payload, api_auth)
+    return backend.client
 
 
 def get_env_var_with_default(var: str, default: str) -> str:
@@ -389,6 +646,8 @@ def startup_check():
     config_auth(config)
     generate_template(template, config)
     print(f'Using URL: {global_var.url}')
+    for backend in backendhandler.pool.backends[1:]:
+        print(f'Also using URL: {backend.url} (weight: {backend.weight:g})')
     print(f'Using outputs directory: {global_var.dir}')
 
     # check if Web UI is running
@@ -415,6 +674,10 @@ def startup_check():
 
 
 def files_check():
+    # every channel's defaults are kept in one store, with any old per-channel files brought in
+    channel_store.open(f'{path}channels.db')
+    channel_store.migrate(path)
+
     # load random messages for aiya to say
     with open(f'{path}messages.csv', encoding='UTF-8') as csv_file:
         message_data = list(csv.reader(csv_file, delimiter='|'))
@@ -429,6 +692,7 @@ def files_check():
         print(f'Uh oh, stats.txt missing. Creating a new one.')
         with open(f'{path}stats.txt', 'w') as f:
             f.write('0')
+    statshandler.stats.load(path)
 
     header = ['display_name', 'model_full_name', 'activator_token']
     unset_model = ['Default', '', '']
@@ -469,11 +733,33 @@ def files_check():
     if dir_exists is False:
         print(f"The folder for DIR doesn't exist! Creating folder at {global_var.dir}.")
         os.mkdir(global_var.dir)
+    outputhandler.index.open(f'{path}outputs.db')
 
     populate_global_vars()
 
 
 def populate_global_vars():
+    apply_config()
+    apply_catalogs(fetch_catalogs())
+    # note which checkpoint each backend has loaded so the queue can avoid swapping models
+    for backend in backendhandler.pool.backends:
+        try:
+            backend.fetch_options(authenticate_user(backend))
+        except(Exception,):
+            pass
+
+
+# the same on refresh, when jobs may be setting options too
+async def refresh_options():
+    for backend in backendhandler.pool.backends:
+        try:
+            await backend.refresh_options(authenticate_client(backend))
+        except(Exception,):
+            pass
+
+
+# everything that comes from config.toml, it doesn't wait on the Web UI
+def apply_config():
     # update global vars with stuff from config
     with open(f'{path}config.toml', 'r') as fileObj:
         content = fileObj.read()
@@ -485,11 +771,35 @@ def populate_global_vars():
 
     global_var.save_outputs = config['save_outputs']
     global_var.queue_limit = config['queue_limit']
+    global_var.queue_cost_limit = config['queue_cost_limit']
+    global_var.queue_cost_max = config['queue_cost_max']
+    global_var.persist_queue = config['persist_queue']
+    global_var.image_processes = config['image_processes']
+    # start the image processes on the first load, before the stats and output threads below
+    imagehandler.image_pool.start(global_var.image_processes)
+    imagehandler.image_pool.memory_limit = config['grid_memory_limit'] * 1024 * 1024
+    statshandler.stats.start(config['stats_interval'])
+    outputhandler.writer.configure(config['output_writers'], config['output_queue_size'], config['output_fsync'])
+    global_var.output_format = str(config['output_format']).upper().replace('JPG', 'JPEG')
+    global_var.upload_size_limit = config['upload_size_limit']
+    queuehandler.GlobalQueue.scheduler.guild_weights = {str(k): max(float(v), 0.1) for k, v in config['guild_weights'].items()}
+    backendhandler.pool.jobs_per_backend = max(config['backend_jobs'], 1)
+    backendhandler.pool.timeout = (config['connect_timeout'] or None, config['read_timeout'] or None)
+    queuehandler.GlobalQueue.scheduler.configure_lane('draw', config['draw_concurrency'], config['draw_weight'])
+    queuehandler.GlobalQueue.scheduler.configure_lane('light', config['light_concurrency'], config['light_weight'])
+    queuehandler.GlobalQueue.scheduler.affinity_window = config['model_affinity']
+    queuehandler.GlobalQueue.scheduler.affinity_skips = config['model_affinity_skips']
+    queuehandler.GlobalQueue.scheduler.coalesce_limit = config['coalesce_draws']
     global_var.batch_buttons = config['batch_buttons']
     global_var.restrict_buttons = config['restrict_buttons']
     global_var.quick_upscale_resize = config['quick_upscale_resize']
+    global_var.info_cache_size = config['info_cache_size']
+    global_var.info_cache_ttl = config['info_cache_ttl']
     global_var.prompt_ban_list = [x for x in config['prompt_ban_list']]
     global_var.prompt_ignore_list = [x for x in config['prompt_ignore_list']]
+    global_var.prompt_ban_pattern = word_pattern(global_var.prompt_ban_list, True, config['prompt_match_words'] == 'True')
+    global_var.prompt_ignore_pattern = word_pattern(global_var.prompt_ignore_list, False,
+                                                    config['prompt_match_words'] == 'True')
     global_var.display_ignored_words = config['display_ignored_words']
     global_var.negative_prompt_prefix = [x for x in config['negative_prompt_prefix']]
     # slash command doesn't update this dynamically. Changes to size need a restart.
@@ -498,6 +808,12 @@ def populate_global_vars():
         global_var.size_range_exceed = [x for x in global_var.size_range]
         global_var.size_range = []
 
+
+# everything the Web UI lists, gathered into new lists so the ones in use aren't touched while this waits on it
+def fetch_catalogs():
+    catalogs = SimpleNamespace(model_info={}, sampler_names=[], style_names={}, facefix_models=[],
+                               embeddings_1=[], embeddings_2=[], hyper_names=[], lora_names=[], extra_nets=[],
+                               upscaler_names=[], hires_upscaler_names=[])
     # create persistent session since we'll need to do a few API calls
     s = authenticate_user()
 
@@ -511,33 +827,31 @@ def populate_global_vars():
     r = s.get(global_var.url + "/sdapi/v1/sd-models")
     for s1 in r1.json():
         try:
-            global_var.sampler_names.append(s1['name'])
+            catalogs.sampler_names.append(s1['name'])
         except(Exception,):
             # throw in last exception error for anything that wasn't caught earlier
             print("Can't connect to API for some reason!"
                   "Please check your .env URL or credentials.")
             os.system("pause")
-    global_var.style_names['None'] = ''
+    catalogs.style_names['None'] = ''
     for s2 in r2.json():
-        global_var.style_names[s2['name']] = s2['prompt'], s2['negative_prompt']
+        catalogs.style_names[s2['name']] = s2['prompt'], s2['negative_prompt']
     for s3 in r3.json():
-        global_var.facefix_models.append(s3['name'])
+        catalogs.facefix_models.append(s3['name'])
     for s4, shape in r4.json()['loaded'].items():
         if shape['shape'] == 768:
-            global_var.embeddings_1.append(s4)
+            catalogs.embeddings_1.append(s4)
         if shape['shape'] == 1024:
-            global_var.embeddings_2.append(s4)
+            catalogs.embeddings_2.append(s4)
     for s4, shape in r4.json()['skipped'].items():
         if shape['shape'] == 768:
-            global_var.embeddings_1.append(s4)
+            catalogs.embeddings_1.append(s4)
         if shape['shape'] == 1024:
-            global_var.embeddings_2.append(s4)
+            catalogs.embeddings_2.append(s4)
     for s5 in r5.json():
-        global_var.hyper_names.append(s5['name'])
+        catalogs.hyper_names.append(s5['name'])
     for s6 in r6.json():
-        global_var.upscaler_names.append(s6['name'])
-    if 'SwinIR_4x' in global_var.upscaler_names:
-        template['upscaler_1'] = 'SwinIR_4x'
+        catalogs.upscaler_names.append(s6['name'])
 
     # create nested dict for models based on display_name in models.csv
     # model_info[0] = display name (top level)
@@ -553,11 +867,11 @@ def populate_global_vars():
                 norm_api_path = os.path.normpath(model['filename'])
                 if norm_csv_path.split(os.sep)[-1] == norm_api_path.split(os.sep)[-1] \
                         or norm_csv_path.replace(os.sep, '_') == model['model_name']:
-                    global_var.model_info[row[0]] = model['title'], model['model_name'], model['hash'], row[2]
+                    catalogs.model_info[row[0]] = model['title'], model['model_name'], model['hash'], row[2]
                     break
     # add "Default" if models.csv is on default, or if no model matches are found
-    if not global_var.model_info:
-        global_var.model_info[row[0]] = '', '', '', ''
+    if not catalogs.model_info:
+        catalogs.model_info[row[0]] = '', '', '', ''
 
     # iterate through config for anything unobtainable from API
     config_url = s.get(global_var.url + "/config")
@@ -567,20 +881,49 @@ def populate_global_vars():
             try:
                 if c['props']:
                     if c['props']['elem_id'] == 'setting_sd_lora':
-                        global_var.lora_names = c['props']['choices']
+                        catalogs.lora_names = c['props']['choices']
                     if c['props']['elem_id'] == 'txt2img_hr_upscaler':
-                        global_var.hires_upscaler_names = c['props']['choices']
+                        catalogs.hires_upscaler_names = c['props']['choices']
             except(Exception,):
                 pass
     except(Exception,):
         print("Trouble accessing Web UI config! I can't pull the LoRAs or High-res upscaler lists!")
     # format some global lists, ensure default "None" options exist
-    if 'None' not in global_var.facefix_models:
-        global_var.facefix_models.insert(0, 'None')
-    if 'None' not in global_var.hyper_names:
-        global_var.hyper_names.insert(0, 'None')
-    if '' in global_var.lora_names:
-        global_var.lora_names.remove('')
-    global_var.extra_nets = global_var.hyper_names + global_var.lora_names
-    global_var.lora_names.insert(0, 'None')
-    global_var.hires_upscaler_names.insert(0, 'Disabled')
+    if 'None' not in catalogs.facefix_models:
+        catalogs.facefix_models.insert(0, 'None')
+    if 'None' not in catalogs.hyper_names:
+        catalogs.hyper_names.insert(0, 'None')
+    if '' in catalogs.lora_names:
+        catalogs.lora_names.remove('')
+    catalogs.extra_nets = catalogs.hyper_names + catalogs.lora_names
+    catalogs.lora_names.insert(0, 'None')
+    catalogs.hires_upscaler_names.insert(0, 'Disabled')
+    return catalogs
+
+
+# the new lists replace the old ones all at once, so nothing ever sees them half filled
+def apply_catalogs(catalogs):
+    for key, value in vars(catalogs).items():
+        setattr(global_var, key, value)
+    if 'SwinIR_4x' in global_var.upscaler_names:
+        template['upscaler_1'] = 'SwinIR_4x'
+    # anything worked out from the old lists is out of date now, and so are channel settings merged with the old template
+    global_var.catalog_version += 1
+    channel_cache.clear()
+    reset_missing_models()
+
+
+# channels set to a model that isn't in models.csv or on the Web UI anymore go back to the default one
+def reset_missing_models():
+    models = global_var.model_info
+    # no checkpoints from the Web UI is more likely a hiccup than every model being gone
+    if not any(x[0] for x in models.values()):
+        return
+    default = template['data_model'] if template['data_model'] in models else ''
+    for model in channel_store.models():
+        if model in ('', 'Default') or model in models:
+            continue
+        channels = channel_store.find_model(model)
+        for channel_id in channels:
+            update(channel_id, 'data_model', default)
+        print(f"The model {model} isn't around anymore, {len(channels)} channel(s) are back on the default model.")
@@ -1,3 +1,4 @@
+import asyncio
 import discord
 from discord import option
 from discord.ext import commands
@@ -226,6 +227,8 @@ class SettingsCog(commands.Cog):
         current, new, new_n_prompt = '', '', ''
         dummy_prompt, lora_multi, hyper_multi = '', 0.85, 0.85
         set_new = False
+        # everything that's changed is saved together at the end
+        changes = {}
 
         if current_settings:
             cur_set = settings.read(channel)
@@ -247,16 +250,12 @@ class SettingsCog(commands.Cog):
 
         # run function to update global variables
         if refresh:
-            settings.global_var.model_info.clear()
-            settings.global_var.sampler_names.clear()
-            settings.global_var.facefix_models.clear()
-            settings.global_var.style_names.clear()
-            settings.global_var.embeddings_1.clear()
-            settings.global_var.embeddings_2.clear()
-            settings.global_var.hyper_names.clear()
-            settings.global_var.lora_names.clear()
-            settings.global_var.upscaler_names.clear()
-            settings.populate_global_vars()
+            settings.apply_config()
+            # asking the Web UI for its lists is kept off the event loop, and the old lists stay in use until
+            # the new ones are all here
+            catalogs = await asyncio.get_running_loop().run_in_executor(None, settings.fetch_catalogs)
+            settings.apply_catalogs(catalogs)
+            await settings.refresh_options()
             embed.add_field(name=f'Refreshed!', value=f'Updated global lists', inline=False)
 
         # run through each command and update the defaults user selects
@@ -267,64 +266,64 @@ class SettingsCog(commands.Cog):
                 new_n_prompt = ' '
             elif len(new_n_prompt) > 1024:
                 new_n_prompt = f'{new_n_prompt[:1010]}....'
-            settings.update(channel, 'negative_prompt', n_prompt)
+            changes['negative_prompt'] = n_prompt
 
         if data_model is not None:
-            settings.update(channel, 'data_model', data_model)
+            changes['data_model'] = data_model
             new += f'\nData model: ``"{data_model}"``'
             set_new = True
 
         if max_steps != 1:
-            settings.update(channel, 'max_steps', max_steps)
+            changes['max_steps'] = max_steps
             new += f'\nMax steps: ``{max_steps}``'
             # automatically lower default steps if max steps goes below it
             if max_steps < reviewer['steps']:
-                settings.update(channel, 'steps', max_steps)
+                changes['steps'] = max_steps
                 new += f'\nDefault steps is too high! Lowering to ``{max_steps}``.'
             set_new = True
 
         if width is not None:
-            settings.update(channel, 'width', width)
+            changes['width'] = width
             new += f'\nWidth: ``"{width}"``'
             set_new = True
 
         if height is not None:
-            settings.update(channel, 'height', height)
+            changes['height'] = height
             new += f'\nHeight: ``"{height}"``'
             set_new = True
 
         if guidance_scale is not None:
             try:
                 float(guidance_scale)
-                settings.update(channel, 'guidance_scale', guidance_scale)
+                changes['guidance_scale'] = guidance_scale
                 new += f'\nGuidance Scale: ``{guidance_scale}``'
             except(Exception,):
-                settings.update(channel, 'guidance_scale', '7.0')
+                changes['guidance_scale'] = '7.0'
                 new += f'\nHad trouble setting Guidance Scale! Setting to default of `7.0`.'
             set_new = True
 
         if sampler is not None:
-            settings.update(channel, 'sampler', sampler)
+            changes['sampler'] = sampler
             new += f'\nSampler: ``"{sampler}"``'
             set_new = True
 
         if styles is not None:
-            settings.update(channel, 'style', styles)
+            changes['style'] = styles
             new += f'\nStyle: ``"{styles}"``'
             set_new = True
 
         if facefix is not None:
-            settings.update(channel, 'facefix', facefix)
+            changes['facefix'] = facefix
             new += f'\nFacefix: ``"{facefix}"``'
             set_new = True
 
         if highres_fix is not None:
-            settings.update(channel, 'highres_fix', highres_fix)
+            changes['highres_fix'] = highres_fix
             new += f'\nhighres_fix: ``"{highres_fix}"``'
             set_new = True
 
         if clip_skip is not None:
-            settings.update(channel, 'clip_skip', clip_skip)
+            changes['clip_skip'] = clip_skip
             new += f'\nCLIP skip: ``{clip_skip}``'
             set_new = True
 
@@ -332,9 +331,9 @@ class SettingsCog(commands.Cog):
             message = ''
             if ':' in hypernet:
                 dummy_prompt, hypernet, hyper_multi = settings.extra_net_check(dummy_prompt, hypernet, hyper_multi)
-                settings.update(channel, 'hypernet_multi', hyper_multi)
+                changes['hypernet_multi'] = hyper_multi
                 message = f' (multiplier: ``{hyper_multi}``)'
-            settings.update(channel, 'hypernet', hypernet)
+            changes['hypernet'] = hypernet
             new += f'\nHypernet: ``"{hypernet}"``{message}'
             set_new = True
 
@@ -342,19 +341,19 @@ class SettingsCog(commands.Cog):
             message = ''
             if ':' in lora:
                 dummy_prompt, lora, lora_multi = settings.extra_net_check(dummy_prompt, lora, lora_multi)
-                settings.update(channel, 'lora_multi', lora_multi)
+                changes['lora_multi'] = lora_multi
                 message = f' (multiplier: ``{lora_multi}``)'
-            settings.update(channel, 'lora', lora)
+            changes['lora'] = lora
             new += f'\nLoRA: ``"{lora}"``{message}'
             set_new = True
 
         if strength is not None:
-            settings.update(channel, 'strength', strength)
+            changes['strength'] = strength
             new += f'\nStrength: ``"{strength}"``'
             set_new = True
 
         if upscaler_1 is not None:
-            settings.update(channel, 'upscaler_1', upscaler_1)
+            changes['upscaler_1'] = upscaler_1
             new += f'\nUpscaler 1: ``"{upscaler_1}"``'
             set_new = True
 
@@ -362,27 +361,27 @@ class SettingsCog(commands.Cog):
             batch_check = settings.batch_format(reviewer['batch'])
             max_batch = settings.batch_format(max_batch)
 
-            settings.update(channel, 'max_batch', f'{max_batch[0]},{max_batch[1]}')
+            changes['max_batch'] = f'{max_batch[0]},{max_batch[1]}'
             new += f'\nMax batch (count,size): ``{max_batch[0]},{max_batch[1]}``'
             # automatically lower default batch if max batch goes below it
             if max_batch[0] < batch_check[0]:
-                settings.update(channel, 'batch', f'{max_batch[0]},{batch_check[1]}')
+                changes['batch'] = f'{max_batch[0]},{batch_check[1]}'
                 new += f'\nDefault batch count is too high! Lowering to ``{max_batch[0]}``.'
             if max_batch[1] < batch_check[1]:
                 if max_batch[0] < batch_check[0]:
-                    settings.update(channel, 'batch', f'{max_batch[0]},{max_batch[1]}')
+                    changes['batch'] = f'{max_batch[0]},{max_batch[1]}'
                 else:
-                    settings.update(channel, 'batch', f'{batch_check[0]},{max_batch[1]}')
+                    changes['batch'] = f'{batch_check[0]},{max_batch[1]}'
                 new += f'\nDefault batch size is too high! Lowering to ``{max_batch[1]}``.'
             set_new = True
 
         # review settings again in case user is trying to set steps/counts and max steps/counts simultaneously
-        reviewer = settings.read(channel)
+        reviewer = {**settings.read(channel), **changes}
         if steps is not None:
             if steps > reviewer['max_steps']:
                 new += f"\nMax steps is ``{reviewer['max_steps']}``! You can't go beyond it!"
             else:
-                settings.update(channel, 'steps', steps)
+                changes['steps'] = steps
                 new += f'\nSteps: ``{steps}``'
             set_new = True
 
@@ -395,10 +394,13 @@ class SettingsCog(commands.Cog):
             elif batch[1] > max_batch_check[1]:
                 new += f"\nMax batch size is ``{max_batch_check[1]}``! You can't go beyond it!"
             else:
-                settings.update(channel, 'batch', f'{batch[0]},{batch[1]}')
+                changes['batch'] = f'{batch[0]},{batch[1]}'
                 new += f'\nbatch (count,size): ``{batch[0]},{batch[1]}``'
             set_new = True
 
+        if changes:
+            settings.update_many(channel, changes)
+
         if set_new:
             embed.add_field(name=f'New defaults', value=new, inline=False)
         if new_n_prompt:
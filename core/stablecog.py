@@ -1,20 +1,24 @@
 import base64
 import discord
 import io
+import json
 import math
 import random
-import requests
 import time
 import traceback
-from PIL import Image, PngImagePlugin
+from asyncio import AbstractEventLoop
 from discord import option
 from discord.ext import commands
 from typing import Optional
 
+from core import backendhandler
+from core import imagehandler
+from core import outputhandler
 from core import queuehandler
 from core import viewhandler
 from core import settings
 from core import settingscog
+from core import statshandler
 
 
 class StableCog(commands.Cog, name='Stable Diffusion', description='Create images from natural language.'):
@@ -238,13 +242,14 @@ class StableCog(commands.Cog, name='Stable Diffusion', description='Create image
         else:
             print(f'Request -- {ctx.author.name}#{ctx.author.discriminator} -- Prompt: {prompt} -- Using model: {data_model}')
 
-        if seed == -1:
+        random_seed = seed == -1
+        if random_seed:
             seed = random.randint(0, 0xFFFFFFFF)
 
         # url *will* override init image for compatibility, can be changed here
         if init_url:
             try:
-                init_image = requests.get(init_url)
+                init_image = backendhandler.RemoteImage(init_url, await backendhandler.pool.download(init_url))
             except(Exception,):
                 await ctx.send_response('URL image not found!\nI will do my best without it!')
 
@@ -331,20 +336,20 @@ class StableCog(commands.Cog, name='Stable Diffusion', description='Create image
             init_image, batch, styles, facefix, highres_fix, clip_skip, extra_net, epoch_time)
         
         view = viewhandler.DrawView(input_tuple)
+        draw_object = queuehandler.DrawObject(self, *input_tuple, view)
+        draw_object.random_seed = random_seed
         # setup the queue
-        user_queue_limit = settings.queue_check(ctx.author)
-        if queuehandler.GlobalQueue.dream_thread.is_alive():
-            if user_queue_limit == "Stop":
-                await ctx.send_response(content=f"Please wait! You're past your queue limit of {settings.global_var.queue_limit}.", ephemeral=True)
-            else:
-                queuehandler.GlobalQueue.queue.append(queuehandler.DrawObject(self, *input_tuple, view))
-        else:
-            await queuehandler.process_dream(self, queuehandler.DrawObject(self, *input_tuple, view))
-        if user_queue_limit != "Stop":
-            await ctx.send_response(f'<@{ctx.author.id}>, {settings.messages()}\nQueue: ``{len(queuehandler.GlobalQueue.queue)}`` - ``{simple_prompt}``\nSteps: ``{steps}``{reply_adds}')
+        check = settings.queue_check(ctx.author, draw_object)
+        if check is not None:
+            await ctx.send_response(content=settings.queue_refusal(check), ephemeral=True)
+            return
+        queue_position = queuehandler.submit(draw_object)
+        await ctx.send_response(f'<@{ctx.author.id}>, {settings.messages()}\nQueue: ``{queue_position}`` - ``{simple_prompt}``\nSteps: ``{steps}`` - Cost: ``{draw_object.cost:.0f}`` - ETA: ``~{draw_object.eta:.0f}s``{reply_adds}')
 
     # the function to queue Discord posts
-    def post(self, event_loop: queuehandler.GlobalQueue.post_event_loop, post_queue_object: queuehandler.PostObject):
+    def post(self, event_loop: AbstractEventLoop, post_queue_object: queuehandler.PostObject):
+        if post_queue_object.download_menu:
+            post_queue_object.view.add_download_menu()
         event_loop.create_task(
             post_queue_object.ctx.channel.send(
                 content=post_queue_object.content,
@@ -352,11 +357,9 @@ class StableCog(commands.Cog, name='Stable Diffusion', description='Create image
                 view=post_queue_object.view
             )
         )
-        if queuehandler.GlobalQueue.post_queue:
-            self.post(self.event_loop, self.queue.pop(0))
 
     # generate the image
-    def dream(self, event_loop: queuehandler.GlobalQueue.event_loop, queue_object: queuehandler.DrawObject):
+    async def dream(self, event_loop: AbstractEventLoop, queue_object: queuehandler.DrawObject):
         try:
             start_time = time.time()
 
@@ -377,7 +380,7 @@ class StableCog(commands.Cog, name='Stable Diffusion', description='Create image
                 "seed_resize_from_w": -1,
                 "denoising_strength": None,
                 "n_iter": queue_object.batch[0],
-                "batch_size": queue_object.batch[1],
+                "batch_size": queue_object.batch[1] + len(queue_object.merged),
                 "styles": [
                     queue_object.styles
                 ]
@@ -385,7 +388,7 @@ class StableCog(commands.Cog, name='Stable Diffusion', description='Create image
 
             # update payload if init_img or init_url is used
             if queue_object.init_image is not None:
-                image = base64.b64encode(requests.get(queue_object.init_image.url, stream=True).content).decode('utf-8')
+                image = base64.b64encode(await backendhandler.read_image(queue_object.init_image)).decode('utf-8')
                 img_payload = {
                     "init_images": [
                         'data:image/png;base64,' + image
@@ -422,184 +425,191 @@ class StableCog(commands.Cog, name='Stable Diffusion', description='Create image
             payload.update(override_payload)
 
             # send normal payload to webui and only send model payload if one is defined
-            s = settings.authenticate_user()
+            backend = queue_object.backend
+            client = settings.authenticate_client(backend)
 
             if queue_object.data_model != '':
-                s.post(url=f'{settings.global_var.url}/sdapi/v1/options', json=model_payload)
+                await backend.set_options(client, model_payload)
             if queue_object.init_image is not None:
-                response = s.post(url=f'{settings.global_var.url}/sdapi/v1/img2img', json=payload)
+                response = await client.img2img(payload)
             else:
-                response = s.post(url=f'{settings.global_var.url}/sdapi/v1/txt2img', json=payload)
+                response = await client.txt2img(payload)
             response_data = response.json()
             end_time = time.time()
 
-            # create safe/sanitized filename
-            keep_chars = (' ', '.', '_')
-            file_name = "".join(c for c in queue_object.simple_prompt if c.isalnum() or c in keep_chars).rstrip()
-            epoch_time = queue_object.epoch_time
-
-            # save local copy of image and prepare PIL images
-            image_data = response_data['images']
-            count = 0
-            image_count = len(image_data)
-            batch = False
-
-            # setup batch params
-            if queue_object.batch[0] > 1 or queue_object.batch[1] > 1:
-                batch = True
-                grids = []
-                images = []
-                aspect_ratio = queue_object.width / queue_object.height
-                num_grids = math.ceil(image_count / 25)
-                grid_count = 25 if num_grids > 1 else image_count
-                last_grid_count = image_count % 25
-                if num_grids > 1 and image_count % 25 == 0:
-                    last_grid_count = 25
-
-                if aspect_ratio <= 1:
-                    grid_cols = int(math.ceil(math.sqrt(grid_count)))
-                    grid_rows = math.ceil(grid_count / grid_cols)
-                    if last_grid_count > 0:
-                        last_grid_cols = int(math.ceil(math.sqrt(last_grid_count)))
-                        last_grid_rows = math.ceil(last_grid_count / last_grid_cols)
-                else:
-                    grid_rows = int(math.ceil(math.sqrt(grid_count)))
-                    grid_cols = math.ceil(grid_count / grid_rows)
-                    if last_grid_count > 0:
-                        last_grid_rows = int(math.ceil(math.sqrt(last_grid_count)))
-                        last_grid_cols = math.ceil(last_grid_count / last_grid_rows)
-
-                for i in range(num_grids):
-                    if i == num_grids:
-                        continue
-                    
-                    if i < num_grids - 1 or last_grid_count == 0:
-                        width = grid_cols * queue_object.width
-                        height = grid_rows * queue_object.height
-                    else: 
-                        width = last_grid_cols * queue_object.width
-                        height = last_grid_rows * queue_object.height
-                    image = Image.new('RGB', (width, height))
-                    grids.append(image)
-
-            for i in image_data:
-                count += 1
-                image = Image.open(io.BytesIO(base64.b64decode(i)))
-
-                # grab png info
-                png_payload = {
-                    "image": "data:image/png;base64," + i
-                }
-                png_response = s.post(url=f'{settings.global_var.url}/sdapi/v1/png-info', json=png_payload)
+            # the response already has the parameters of each image, so there's no need to ask png-info
+            infos = response_info(response_data)
+
+            # a coalesced job hands each image back to the draw that asked for it
+            if queue_object.merged:
+                jobs = [queue_object] + queue_object.merged
+                for index, job in enumerate(jobs):
+                    # the seed in the queue reply isn't the one that's drawn anymore, so the post says which one is
+                    job.reseeded = job.seed != queue_object.seed + index
+                    job.seed = queue_object.seed + index
+                    view_tuple = list(job.view.input_tuple)
+                    view_tuple[10] = job.seed
+                    # the download menu looks its images up by seed, so the view is made again with the new one
+                    job.view = viewhandler.DrawView(tuple(view_tuple))
+                    await queuehandler.run_blocking(self.post_results, job, response_data['images'][index:index + 1],
+                                                    infos[index:index + 1], start_time, end_time)
+            else:
+                await queuehandler.run_blocking(self.post_results, queue_object, response_data['images'], infos,
+                                                start_time, end_time)
 
-                metadata = PngImagePlugin.PngInfo()
-                metadata.add_text("parameters", png_response.json().get("info"))
-                str_parameters = png_response.json().get("info")
+        except KeyError as e:
+            embed = discord.Embed(title='txt2img failed', description=f'An invalid parameter was found!\n{e}',
+                                  color=settings.global_var.embed_color)
+            for job in [queue_object] + queue_object.merged:
+                await job.ctx.channel.send(embed=embed)
+        except Exception as e:
+            embed = discord.Embed(title='txt2img failed', description=f'{e}\n{traceback.print_exc()}',
+                                  color=settings.global_var.embed_color)
+            for job in [queue_object] + queue_object.merged:
+                await job.ctx.channel.send(embed=embed)
+
+    # save and post the images for one draw
+    def post_results(self, queue_object: queuehandler.DrawObject, image_data, infos, start_time, end_time):
+        # create safe/sanitized filename
+        keep_chars = (' ', '.', '_')
+        file_name = "".join(c for c in queue_object.simple_prompt if c.isalnum() or c in keep_chars).rstrip()
+        epoch_time = queue_object.epoch_time
+
+        # save local copy of image and prepare PIL images
+        count = 0
+        image_count = len(image_data)
+        batch = False
+
+        # setup batch params
+        if queue_object.batch[0] > 1 or queue_object.batch[1] > 1:
+            batch = True
+            tile_size = (queue_object.width, queue_object.height)
+            aspect_ratio = queue_object.width / queue_object.height
+            num_grids = math.ceil(image_count / 25)
+            grid_count = 25 if num_grids > 1 else image_count
+            last_grid_count = image_count % 25
+            if num_grids > 1 and image_count % 25 == 0:
+                last_grid_count = 25
+
+            if aspect_ratio <= 1:
+                grid_cols = int(math.ceil(math.sqrt(grid_count)))
+                grid_rows = math.ceil(grid_count / grid_cols)
+                if last_grid_count > 0:
+                    last_grid_cols = int(math.ceil(math.sqrt(last_grid_count)))
+                    last_grid_rows = math.ceil(last_grid_count / last_grid_cols)
+            else:
+                grid_rows = int(math.ceil(math.sqrt(grid_count)))
+                grid_cols = math.ceil(grid_count / grid_rows)
+                if last_grid_count > 0:
+                    last_grid_rows = int(math.ceil(math.sqrt(last_grid_count)))
+                    last_grid_cols = math.ceil(last_grid_count / last_grid_rows)
+
+        # set up discord message
+        noun_descriptor = "drawing" if image_count == 1 else f'{image_count} drawings'
+        draw_time = '{0:.3f}'.format(end_time - start_time)
+        message = f'my {noun_descriptor} of ``{queue_object.simple_prompt}`` took me ``{draw_time}`` seconds!'
+        if queue_object.reseeded:
+            message += f'\nIt was drawn alongside matching requests, with the seed ``{queue_object.seed}``.'
+
+        view = queue_object.view
+        # images can be posted as smaller previews, the PNGs are kept on disk for the download menu
+        image_format = settings.global_var.output_format
+        size_limit = int(settings.global_var.upload_size_limit * 1024 * 1024)
+
+        # each image goes into its grid as soon as it's saved, and each grid is posted as soon as it's full,
+        # so only one grid and one image are held at a time
+        grid = None
+        current_grid = 0
+        try:
+            for index, str_parameters in enumerate(infos):
+                count += 1
+                # the PNG from the API is kept as it is, it only has to be decoded to go into a grid
+                png_bytes = imagehandler.with_parameters(base64.b64decode(image_data[index]), str_parameters)
+                # let go of the base64 now that it's been decoded
+                image_data[index] = None
 
                 file_path = f'{settings.global_var.dir}/{epoch_time}-{queue_object.seed}-{count}.png'
 
-                # if we are using a batch we need to save the files to disk
-                if settings.global_var.save_outputs == 'True' or batch == True:
-                    image.save(file_path, pnginfo=metadata)
-                    print(f'Saved image: {file_path}')
-
-                if batch == True:
-                    image_data = (image, file_path, str_parameters)
-                    images.append(image_data)
-                    
-                settings.stats_count(1)
+                # if we are using a batch or previews we need to save the files to disk,
+                # same for a PNG that's too big to post, since a smaller copy is posted instead
+                if settings.global_var.save_outputs == 'True' or batch == True or \
+                        not imagehandler.keeps_png(png_bytes, image_format, size_limit):
+                    outputhandler.writer.write(file_path, png_bytes, {
+                        'batch_id': f'{epoch_time}-{queue_object.seed}', 'image_id': count,
+                        'user_id': queue_object.ctx.author.id, 'channel_id': queue_object.ctx.channel.id,
+                        'prompt': queue_object.prompt, 'model': queue_object.data_model,
+                        'seed': queue_object.seed + count - 1, 'width': queue_object.width,
+                        'height': queue_object.height})
 
                 # increment seed for view when using batch
-                if count != len(image_data):
+                if count != image_count:
                     batch_seed = list(queue_object.view.input_tuple)
                     batch_seed[10] += 1
                     new_tuple = tuple(batch_seed)
                     queue_object.view.input_tuple = new_tuple
 
-            # set up discord message
-            content = f'> for {queue_object.ctx.author.name}'
-            noun_descriptor = "drawing" if image_count == 1 else f'{image_count} drawings'
-            draw_time = '{0:.3f}'.format(end_time - start_time)
-            message = f'my {noun_descriptor} of ``{queue_object.simple_prompt}`` took me ``{draw_time}`` seconds!'
-
-            view = queue_object.view
-
-            if batch == True:
-                current_grid = 0
-                grid_index = 0
-                for grid_image in images:
-                    if grid_index >= grid_count:
-                        grid_index = 0
-                        current_grid += 1
+                if batch == False:
+                    continue
 
+                if grid is None:
                     if current_grid < num_grids - 1 or last_grid_count == 0:
-                        grid_y, grid_x = divmod(grid_index, grid_cols)
-                        grid_x *= queue_object.width
-                        grid_y *= queue_object.height
-                    else:
-                        grid_y, grid_x = divmod(grid_index, last_grid_cols)
-                        grid_x *= queue_object.width
-                        grid_y *= queue_object.height
-
-                    grids[current_grid].paste(grid_image[0], (grid_x, grid_y))
-                    grid_index += 1
-
-                
-                current_grid = 0
-                for grid in grids:
-                    if current_grid < num_grids -1 or last_grid_count == 0:
-                        id_start = current_grid * grid_count + 1
-                        id_end = id_start + grid_count - 1
-                    else:
-                        id_start = current_grid * grid_count + 1
-                        id_end = id_start + last_grid_count - 1
-                    filename=f'{queue_object.seed}-{current_grid}.png'
-                    file = add_metadata_to_image(grid,images[current_grid * 25][2], filename)
-                    if current_grid == 0:
-                        content = f'<@{queue_object.ctx.author.id}>, {message}\n Batch ID: {epoch_time}-{queue_object.seed}\n Image IDs: {id_start}-{id_end}'
+                        grid = imagehandler.GridBuilder(grid_count, grid_cols, grid_rows, tile_size, str_parameters)
                     else:
-                        content = f'> for {queue_object.ctx.author.name}, use /info or context menu to retrieve.\n Batch ID: {epoch_time}-{queue_object.seed}\n Image IDs: {id_start}-{id_end}'
-                        view = None
-                        
-                    current_grid += 1
-                    # post discord message
-                    queuehandler.process_post(
-                        self, queuehandler.PostObject(
-                            self, queue_object.ctx, content=content, file=file, embed='', view=view))
-            
-            else:
-                content = f'<@{queue_object.ctx.author.id}>, {message}'
-                filename=f'{queue_object.seed}-{count}.png'
-                file = add_metadata_to_image(image,str_parameters, filename)
+                        grid = imagehandler.GridBuilder(last_grid_count, last_grid_cols, last_grid_rows, tile_size,
+                                                        str_parameters)
+                if not grid.add(png_bytes):
+                    continue
+
+                id_start = current_grid * grid_count + 1
+                id_end = id_start + grid.count - 1
+                grid_bytes, extension = grid.finish(image_format, size_limit)
+                filename=f'{queue_object.seed}-{current_grid}.{extension}'
+                file = discord.File(fp=io.BytesIO(grid_bytes), filename=filename)
+                grid = None
+                if current_grid == 0:
+                    content = f'<@{queue_object.ctx.author.id}>, {message}\n Batch ID: {epoch_time}-{queue_object.seed}\n Image IDs: {id_start}-{id_end}'
+                else:
+                    content = f'> for {queue_object.ctx.author.name}, use /info or context menu to retrieve.\n Batch ID: {epoch_time}-{queue_object.seed}\n Image IDs: {id_start}-{id_end}'
+                    view = None
+
+                current_grid += 1
+                # post discord message
                 queuehandler.process_post(
                     self, queuehandler.PostObject(
                         self, queue_object.ctx, content=content, file=file, embed='', view=view))
-
-        except KeyError as e:
-            embed = discord.Embed(title='txt2img failed', description=f'An invalid parameter was found!\n{e}',
-                                  color=settings.global_var.embed_color)
-            event_loop.create_task(queue_object.ctx.channel.send(embed=embed))
-        except Exception as e:
-            embed = discord.Embed(title='txt2img failed', description=f'{e}\n{traceback.print_exc()}',
-                                  color=settings.global_var.embed_color)
-            event_loop.create_task(queue_object.ctx.channel.send(embed=embed))
-        # check each queue for any remaining tasks
-        queuehandler.process_queue()
+        finally:
+            if grid is not None:
+                grid.close()
+        statshandler.stats.record('draw', queue_object.ctx.author.id, queue_object.data_model, count)
+
+        if batch == False:
+            content = f'<@{queue_object.ctx.author.id}>, {message}'
+            if imagehandler.keeps_png(png_bytes, image_format, size_limit):
+                image_bytes, extension = png_bytes, 'png'
+            else:
+                image_bytes, extension = imagehandler.image_pool.run(imagehandler.encode_preview, png_bytes,
+                                                                     str_parameters, image_format, size_limit)
+            filename=f'{queue_object.seed}-{count}.{extension}'
+            file = discord.File(fp=io.BytesIO(image_bytes), filename=filename)
+            # the PNG can only be had from the download menu when something else is posted
+            queuehandler.process_post(
+                self, queuehandler.PostObject(
+                    self, queue_object.ctx, content=content, file=file, embed='', view=view,
+                    download_menu=extension != 'png'))
 
 
 def setup(bot):
     bot.add_cog(StableCog(bot))
 
-def add_metadata_to_image(image, str_parameters, filename):
-    with io.BytesIO() as buffer:
-        # setup metadata
-        metadata = PngImagePlugin.PngInfo()
-        metadata.add_text("parameters", str_parameters)
-        # save image to buffer
-        image.save(buffer, 'PNG', pnginfo=metadata)
 
-        # reset buffer to beginning and return as bytes
-        buffer.seek(0)
-        file = discord.File(fp=buffer, filename=filename)
+# the info string of each image from a txt2img/img2img response
+def response_info(response_data):
+    images = response_data['images']
+    try:
+        info = json.loads(response_data['info'])
+        infotexts = info.get('infotexts') or [info.get('infotext', '')]
+    except(Exception,):
+        infotexts = ['']
+    # anything without its own info gets the first one, the settings only differ by seed
+    return [infotexts[i] if i < len(infotexts) else infotexts[0] for i in range(len(images))]
 
-    return file
@@ -0,0 +1,101 @@
+import atexit
+import json
+import os
+import threading
+from collections import Counter
+
+
+# counts are kept in memory and written out every so often, instead of going to disk for every image
+class Stats:
+    def __init__(self):
+        self.folder = None
+        # images drawn, the number /stats has always shown
+        self.total = 0
+        # jobs asked for by each user
+        self.users = Counter()
+        # images drawn with each model
+        self.models = Counter()
+        # jobs of each command
+        self.commands = Counter()
+        # anything else in stats.txt is kept as it is
+        self.extra_lines = []
+        self.dirty = False
+        self.lock = threading.Lock()
+        # the timer and the exit can both flush
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        # seconds between writes, 0 only writes on exit
+        self.interval = 60
+        self.wake = threading.Event()
+
+    def load(self, folder):
+        self.folder = folder
+        with open(f'{folder}stats.txt', 'r') as f:
+            lines = f.readlines()
+        breakdown = {}
+        if os.path.isfile(f'{folder}stats.json'):
+            with open(f'{folder}stats.json', 'r') as f:
+                breakdown = json.load(f)
+        with self.lock:
+            self.total = int(float(lines[0])) if lines else 0
+            self.extra_lines = [x.strip() for x in lines[1:]]
+            self.users = Counter(breakdown.get('users', {}))
+            self.models = Counter(breakdown.get('models', {}))
+            self.commands = Counter(breakdown.get('commands', {}))
+
+    def start(self, interval):
+        self.interval = interval
+        self.wake.set()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            self.wake.clear()
+            # a new interval from a refresh wakes it up early
+            self.wake.wait(self.interval or None)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Couldn't save the stats: {e}")
+
+    def record(self, command, user_id, model='', images=0):
+        with self.lock:
+            self.commands[command] += 1
+            self.users[str(user_id)] += 1
+            if images:
+                self.total += images
+                self.models[model or 'Default'] += images
+            self.dirty = True
+
+    # copies of the counts, safe to look through while jobs are still counting
+    def snapshot(self):
+        with self.lock:
+            return self.total, Counter(self.users), Counter(self.models), Counter(self.commands)
+
+    # the total goes in stats.txt like always, and everything else next to it
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.dirty or self.folder is None:
+                    return
+                lines = [str(self.total)] + self.extra_lines
+                breakdown = {'users': dict(self.users), 'models': dict(self.models), 'commands': dict(self.commands)}
+                self.dirty = False
+            try:
+                write(f'{self.folder}stats.txt', '\n'.join(lines))
+                write(f'{self.folder}stats.json', json.dumps(breakdown, indent=1))
+            except(Exception,):
+                self.dirty = True
+                raise
+
+
+def write(file_path, text):
+    with open(file_path + '.tmp', 'w') as f:
+        f.write(text)
+    os.replace(file_path + '.tmp', file_path)
+
+
+stats = Stats()
+atexit.register(stats.flush)
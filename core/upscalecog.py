@@ -1,29 +1,28 @@
 import base64
 import discord
 import io
-import requests
 import time
 import traceback
 from asyncio import AbstractEventLoop
 from discord import option
 from discord.ext import commands
 from os.path import splitext, basename
-from PIL import Image
-from threading import Thread
 from typing import Optional
 from urllib.parse import urlparse
 
+from core import backendhandler
+from core import outputhandler
 from core import queuehandler
 from core import viewhandler
 from core import settings
 from core import settingscog
+from core import statshandler
 
 
 class UpscaleCog(commands.Cog):
     def __init__(self, bot):
         self.wait_message = []
         self.bot = bot
-        self.file_name = ''
 
     @commands.Cog.listener()
     async def on_ready(self):
@@ -107,7 +106,7 @@ class UpscaleCog(commands.Cog):
         # url *will* override init image for compatibility, can be changed here
         if init_url:
             try:
-                init_image = requests.get(init_url)
+                init_image = backendhandler.RemoteImage(init_url, await backendhandler.pool.download(init_url))
             except(Exception,):
                 await ctx.send_response('URL image not found!\nI have nothing to work with...', ephemeral=True)
                 has_image = False
@@ -136,17 +135,14 @@ class UpscaleCog(commands.Cog):
         input_tuple = (ctx, resize, init_image, upscaler_1, upscaler_2, upscaler_2_strength, gfpgan, codeformer, upscale_first)
         view = viewhandler.DeleteView(input_tuple)
         # set up the queue if an image was found
-        user_queue_limit = settings.queue_check(ctx.author)
         if has_image:
-            if queuehandler.GlobalQueue.dream_thread.is_alive():
-                if user_queue_limit == "Stop":
-                    await ctx.send_response(content=f"Please wait! You're past your queue limit of {settings.global_var.queue_limit}.", ephemeral=True)
-                else:
-                    queuehandler.GlobalQueue.queue.append(queuehandler.UpscaleObject(self, *input_tuple, view))
-            else:
-                await queuehandler.process_dream(self, queuehandler.UpscaleObject(self, *input_tuple, view))
-            if user_queue_limit != "Stop":
-                await ctx.send_response(f'<@{ctx.author.id}>, {settings.messages()}\nQueue: ``{len(queuehandler.GlobalQueue.queue)}`` - Scale: ``{resize}``x - Upscaler: ``{upscaler_1}``{reply_adds}')
+            upscale_object = queuehandler.UpscaleObject(self, *input_tuple, view)
+            check = settings.queue_check(ctx.author, upscale_object)
+            if check is not None:
+                await ctx.send_response(content=settings.queue_refusal(check), ephemeral=True)
+                return
+            queue_position = queuehandler.submit(upscale_object)
+            await ctx.send_response(f'<@{ctx.author.id}>, {settings.messages()}\nQueue: ``{queue_position}`` - Scale: ``{resize}``x - Upscaler: ``{upscaler_1}``{reply_adds}')
 
     # the function to queue Discord posts
     def post(self, event_loop: AbstractEventLoop, post_queue_object: queuehandler.PostObject):
@@ -157,11 +153,9 @@ class UpscaleCog(commands.Cog):
                 view=post_queue_object.view
             )
         )
-        if queuehandler.GlobalQueue.post_queue:
-            self.post(self.event_loop, self.queue.pop(0))
 
     # generate the image
-    def dream(self, event_loop: AbstractEventLoop, queue_object: queuehandler.UpscaleObject):
+    async def dream(self, event_loop: AbstractEventLoop, queue_object: queuehandler.UpscaleObject):
         try:
             start_time = time.time()
             image_url = queue_object.init_image
@@ -169,16 +163,17 @@ class UpscaleCog(commands.Cog):
             if isinstance(image_url, str) and image_url.startswith('file://'):
                 # If image_url starts with file://, open the file locally and read its contents
                 disassembled = urlparse(image_url)
-                with open(image_url[7:], 'rb') as f:
-                    image = base64.b64encode(f.read()).decode('utf-8')
+                # a batch image from the menu may still be waiting to be saved
+                await outputhandler.writer.settle([image_url[7:]])
+                image = base64.b64encode(await queuehandler.run_blocking(read_file, image_url[7:])).decode('utf-8')
             else:
-                # If image_url doesn't start with file://, use requests to get the image data
+                # If image_url doesn't start with file://, download the image data
                 disassembled = urlparse(image_url.url)
-                image = base64.b64encode(requests.get(image_url.url, stream=True).content).decode('utf-8')
+                image = base64.b64encode(await backendhandler.read_image(image_url)).decode('utf-8')
 
             # pull the name from the image
-            filename, file_ext = splitext(basename(disassembled.path))
-            self.file_name = filename
+            # kept to this job, other upscales can run while this one waits on the Web UI
+            file_name, file_ext = splitext(basename(disassembled.path))
             
             # construct a payload
             payload = {
@@ -197,45 +192,44 @@ class UpscaleCog(commands.Cog):
                 payload.update(up2_payload)
 
             # send normal payload to webui
-            s = settings.authenticate_user()
+            client = settings.authenticate_client(queue_object.backend)
 
-            response = s.post(url=f'{settings.global_var.url}/sdapi/v1/extra-single-image', json=payload)
+            response = await client.extra_single_image(payload)
             response_data = response.json()
             end_time = time.time()
 
             # create safe/sanitized filename
             epoch_time = int(time.time())
-            file_path = f'{settings.global_var.dir}/{epoch_time}-x{queue_object.resize}-{self.file_name[0:120]}.png'
+            file_path = f'{settings.global_var.dir}/{epoch_time}-x{queue_object.resize}-{file_name[0:120]}.png'
 
-            # save local copy of image
+            # save local copy of image and post to discord
             image_data = response_data['image']
-            if settings.global_var.save_outputs == 'True':
-                with open(file_path, "wb") as fh:
-                    fh.write(base64.b64decode(image_data))
-                print(f'Saved image: {file_path}')
 
-            # post to discord
             def post_dream():
-                with io.BytesIO() as buffer:
-                    image = Image.open(io.BytesIO(base64.b64decode(image_data)))
-                    image.save(buffer, 'PNG')
-                    buffer.seek(0)
-
-                    draw_time = '{0:.3f}'.format(end_time - start_time)
-                    message = f'my upscale of ``{queue_object.resize}``x took me ``{draw_time}`` seconds!'
-                    file = discord.File(fp=buffer, filename=f'{self.file_name[0:120]}-{queue_object.resize}.png')
-
-                    queuehandler.process_post(
-                        self, queuehandler.PostObject(
-                            self, queue_object.ctx, content=f'<@{queue_object.ctx.author.id}>, {message}', file=file, embed='', view=queue_object.view))
-            Thread(target=post_dream, daemon=True).start()
+                # the PNG from the API is saved and posted as it is
+                png_bytes = base64.b64decode(image_data)
+                draw_time = '{0:.3f}'.format(end_time - start_time)
+                message = f'my upscale of ``{queue_object.resize}``x took me ``{draw_time}`` seconds!'
+                file = discord.File(fp=io.BytesIO(png_bytes), filename=f'{file_name[0:120]}-{queue_object.resize}.png')
+
+                queuehandler.process_post(
+                    self, queuehandler.PostObject(
+                        self, queue_object.ctx, content=f'<@{queue_object.ctx.author.id}>, {message}', file=file, embed='', view=queue_object.view))
+                statshandler.stats.record('upscale', queue_object.ctx.author.id)
+                if settings.global_var.save_outputs == 'True':
+                    outputhandler.writer.write(file_path, png_bytes, {
+                        'user_id': queue_object.ctx.author.id, 'channel_id': queue_object.ctx.channel.id})
+            await queuehandler.run_blocking(post_dream)
 
         except Exception as e:
             embed = discord.Embed(title='txt2img failed', description=f'{e}\n{traceback.print_exc()}',
                                   color=settings.global_var.embed_color)
-            event_loop.create_task(queue_object.ctx.channel.send(embed=embed))
-        # check each queue for any remaining tasks
-        queuehandler.process_queue()
+            await queue_object.ctx.channel.send(embed=embed)
+
+
+def read_file(file_path):
+    with open(file_path, 'rb') as f:
+        return f.read()
 
 
 def setup(bot):
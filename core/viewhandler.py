@@ -6,6 +6,7 @@ from discord.ui import InputText, Modal, View
 
 from core import ctxmenuhandler
 from core import infocog
+from core import outputhandler
 from core import queuehandler
 from core import settings
 from core import stablecog
@@ -107,12 +108,15 @@ class DrawModal(Modal):
         pen[3] = self.children[1].value
 
         # update the tuple new seed (random if invalid value set)
+        random_seed = False
         try:
             pen[10] = int(self.children[2].value)
         except ValueError:
             pen[10] = random.randint(0, 0xFFFFFFFF)
+            random_seed = True
         if (self.children[2].value == "-1") or (self.children[2].value == ""):
             pen[10] = random.randint(0, 0xFFFFFFFF)
+            random_seed = True
 
         # prepare a validity checker
         new_model, new_token, bad_input = '', '', ''
@@ -156,7 +160,7 @@ class DrawModal(Modal):
             if 'steps:' in line:
                 max_steps = settings.read('% s' % pen[0].channel.id)['max_steps']
                 if 0 < int(line.split(':', 1)[1]) <= max_steps:
-                    pen[5] = line.split(':', 1)[1]
+                    pen[5] = int(line.split(':', 1)[1])
                 else:
                     invalid_input = True
                     embed_err.add_field(name=f"`{line.split(':', 1)[1]}` steps is beyond the boundary!",
@@ -293,12 +297,15 @@ class DrawModal(Modal):
 
             print(f'Redraw -- {interaction.user.name}#{interaction.user.discriminator} -- Prompt: {pen[1]}')
 
-            # check queue again, but now we know user is not in queue
-            if queuehandler.GlobalQueue.dream_thread.is_alive():
-                queuehandler.GlobalQueue.queue.append(queuehandler.DrawObject(stablecog.StableCog(self), *prompt_tuple, DrawView(prompt_tuple)))
-            else:
-                await queuehandler.process_dream(draw_dream, queuehandler.DrawObject(stablecog.StableCog(self), *prompt_tuple, DrawView(prompt_tuple)))
-            await interaction.response.send_message(f'<@{interaction.user.id}>, {settings.messages()}\nQueue: ``{len(queuehandler.GlobalQueue.queue)}``{prompt_output}')
+            # check queue again, now with the cost of the draw as it was edited
+            draw_object = queuehandler.DrawObject(draw_dream, *prompt_tuple, DrawView(prompt_tuple))
+            draw_object.random_seed = random_seed
+            check = settings.queue_check(interaction.user, draw_object)
+            if check is not None:
+                await interaction.response.send_message(content=settings.queue_refusal(check), ephemeral=True)
+                return
+            queue_position = queuehandler.submit(draw_object)
+            await interaction.response.send_message(f'<@{interaction.user.id}>, {settings.messages()}\nQueue: ``{queue_position}``{prompt_output}')
 
 
 # creating the view that holds the buttons for /draw output
@@ -309,14 +316,22 @@ class DrawView(View):
         if isinstance(self.input_tuple, tuple): # only check batch if we are actually a real view
             batch = input_tuple[13]
             batch_count = batch[0] * batch[1]
+            # previews are posted instead of the PNG, which can be downloaded from the menu
+            if batch_count > 1 or settings.global_var.output_format != 'PNG':
+                self.add_download_menu(batch_count)
             if batch_count > 1:
-                download_menu = DownloadMenu(input_tuple[19], input_tuple[10], batch_count, input_tuple)
-                download_menu.callback = download_menu.callback
-                self.add_item(download_menu)
                 upscale_menu = UpscaleMenu(input_tuple[19], input_tuple[10], batch_count, input_tuple)
                 upscale_menu.callback = upscale_menu.callback
                 self.add_item(upscale_menu)
 
+    # a PNG that was too big to post gets the menu too, once that's known
+    def add_download_menu(self, batch_count=1):
+        if any(isinstance(x, DownloadMenu) for x in self.children):
+            return
+        download_menu = DownloadMenu(self.input_tuple[19], self.input_tuple[10], batch_count, self.input_tuple)
+        download_menu.callback = download_menu.callback
+        self.add_item(download_menu)
+
     # the 🖋 button will allow a new prompt and keep same parameters for everything else
     @discord.ui.button(
         custom_id="button_re-prompt",
@@ -330,12 +345,9 @@ class DrawView(View):
                     buttons_free = False
             if buttons_free:
                 # if there's room in the queue, open up the modal
-                user_queue_limit = settings.queue_check(interaction.user)
-                if queuehandler.GlobalQueue.dream_thread.is_alive():
-                    if user_queue_limit == "Stop":
-                        await interaction.response.send_message(content=f"Please wait! You're past your queue limit of {settings.global_var.queue_limit}.", ephemeral=True)
-                    else:
-                        await interaction.response.send_modal(DrawModal(self.input_tuple))
+                check = settings.queue_check(interaction.user)
+                if check is not None:
+                    await interaction.response.send_message(content=settings.queue_refusal(check), ephemeral=True)
                 else:
                     await interaction.response.send_modal(DrawModal(self.input_tuple))
             else:
@@ -371,19 +383,16 @@ class DrawView(View):
 
                 # set up the draw dream and do queue code again for lack of a more elegant solution
                 draw_dream = stablecog.StableCog(self)
-                user_queue_limit = settings.queue_check(interaction.user)
-                if queuehandler.GlobalQueue.dream_thread.is_alive():
-                    if user_queue_limit == "Stop":
-                        await interaction.response.send_message(content=f"Please wait! You're past your queue limit of {settings.global_var.queue_limit}.", ephemeral=True)
-                    else:
-                        queuehandler.GlobalQueue.queue.append(queuehandler.DrawObject(stablecog.StableCog(self), *seed_tuple, DrawView(seed_tuple)))
+                draw_object = queuehandler.DrawObject(draw_dream, *seed_tuple, DrawView(seed_tuple))
+                draw_object.random_seed = True
+                check = settings.queue_check(interaction.user, draw_object)
+                if check is not None:
+                    await interaction.response.send_message(content=settings.queue_refusal(check), ephemeral=True)
                 else:
-                    await queuehandler.process_dream(draw_dream, queuehandler.DrawObject(stablecog.StableCog(self), *seed_tuple, DrawView(seed_tuple)))
-
-                if user_queue_limit != "Stop":
+                    queue_position = queuehandler.submit(draw_object)
                     await interaction.response.send_message(
                         f'<@{interaction.user.id}>, {settings.messages()}\nQueue: '
-                        f'``{len(queuehandler.GlobalQueue.queue)}`` - ``{seed_tuple[1]}``'
+                        f'``{queue_position}`` - ``{seed_tuple[1]}``'
                         f'\nNew Seed:``{seed_tuple[10]}``')
             else:
                 await interaction.response.send_message("You can't use other people's 🎲!", ephemeral=True)
@@ -422,19 +431,15 @@ class DrawView(View):
 
                     # set up the draw dream and do queue code again for lack of a more elegant solution
                     draw_dream = upscalecog.UpscaleCog(self)
-                    user_queue_limit = settings.queue_check(interaction.user)
-                    if queuehandler.GlobalQueue.dream_thread.is_alive():
-                        if user_queue_limit == "Stop":
-                            await interaction.response.send_message(content=f"Please wait! You're past your queue limit of {settings.global_var.queue_limit}.", ephemeral=True)
-                        else:
-                            queuehandler.GlobalQueue.queue.append(queuehandler.UpscaleObject(upscalecog.UpscaleCog(self), *upscale_tuple, DeleteView(upscale_tuple)))
+                    upscale_object = queuehandler.UpscaleObject(draw_dream, *upscale_tuple, DeleteView(upscale_tuple))
+                    check = settings.queue_check(interaction.user, upscale_object)
+                    if check is not None:
+                        await interaction.response.send_message(content=settings.queue_refusal(check), ephemeral=True)
                     else:
-                        await queuehandler.process_dream(draw_dream, queuehandler.UpscaleObject(upscalecog.UpscaleCog(self), *upscale_tuple, DeleteView(upscale_tuple)))
-
-                    if user_queue_limit != "Stop":
+                        queue_position = queuehandler.submit(upscale_object)
                         await interaction.response.send_message(
                             f'<@{interaction.user.id}>, {settings.messages()}\nQueue: '
-                            f'``{len(queuehandler.GlobalQueue.queue)}`` - Upscaling')
+                            f'``{queue_position}`` - Upscaling')
             else:
                 await interaction.response.send_message("You can't use other people's ⬆️!", ephemeral=True)
         except Exception as e:
@@ -507,11 +512,13 @@ class DeleteView(View):
 class DownloadMenu(discord.ui.Select):
     def __init__(self, epoch_time, seed, batch_count, input_tuple):
         self.input_tuple = input_tuple
+        self.batch_id = f'{epoch_time}-{seed}'
         batch_count = min(batch_count, 25)
         max_values = min(batch_count, 25)
         filename = [f"{epoch_time}-{seed}-{i}.png" for i in range(1, batch_count+1)]
         input_options = [(f, str(i)) for i, f in enumerate(filename, start=1)]
-        options = [discord.SelectOption(label=option[1], value=option[0], description=option[0]) for option in input_options]
+        # the image ID is the value, its file is looked up in the output index
+        options = [discord.SelectOption(label=option[1], value=option[1], description=option[0]) for option in input_options]
         super().__init__(custom_id="download_menu", placeholder='Choose images to download...', min_values=1, max_values=max_values, options=options)
     
     async def callback(self, interaction: discord.Interaction):
@@ -521,10 +528,11 @@ class DownloadMenu(discord.ui.Select):
                 if interaction.user.id != self.input_tuple[0].author.id:
                     buttons_free = False
             if buttons_free:
+                image_ids = [int(x) for x in self.values]
+                image_paths = await outputhandler.batch_files(settings.global_var.dir, self.batch_id, image_ids)
                 files = []
-                for value in self.values:
-                    image_path = f'{settings.global_var.dir}/{value}'
-                    file = discord.File(image_path, f'{value}')
+                for image_path in image_paths:
+                    file = discord.File(image_path, os.path.basename(image_path))
                     files.append(file)
                 
                 if files:
@@ -544,10 +552,11 @@ class DownloadMenu(discord.ui.Select):
 class UpscaleMenu(discord.ui.Select):
     def __init__(self, epoch_time, seed, batch_count, input_tuple):
         self.input_tuple = input_tuple
+        self.batch_id = f'{epoch_time}-{seed}'
         batch_count = min(batch_count, 25)
         filename = [f"{epoch_time}-{seed}-{i}.png" for i in range(1, batch_count+1)]
         input_options = [(f, str(i)) for i, f in enumerate(filename, start=1)]
-        options = [discord.SelectOption(label=option[1], value=option[0], description=option[0]) for option in input_options]
+        options = [discord.SelectOption(label=option[1], value=option[1], description=option[0]) for option in input_options]
         super().__init__(custom_id="upscale_menu", placeholder='Choose images to upscale...', min_values=1, max_values=1, options=options)
     
     async def callback(self, interaction: discord.Interaction):
@@ -557,7 +566,8 @@ class UpscaleMenu(discord.ui.Select):
                 if interaction.user.id != self.input_tuple[0].author.id:
                     buttons_free = False
             if buttons_free:
-                partial_path = f'{settings.global_var.dir}/{self.values[0]}'
+                image_paths = await outputhandler.batch_files(settings.global_var.dir, self.batch_id, [int(self.values[0])])
+                partial_path = image_paths[0]
                 full_path = os.path.join(os.getcwd(), partial_path)
                 init_image = 'file://' + full_path
                 ctx = self.input_tuple[0]
@@ -570,19 +580,15 @@ class UpscaleMenu(discord.ui.Select):
 
                 # set up the draw dream and do queue code again for lack of a more elegant solution
                 draw_dream = upscalecog.UpscaleCog(self)
-                user_queue_limit = settings.queue_check(interaction.user)
-                if queuehandler.GlobalQueue.dream_thread.is_alive():
-                    if user_queue_limit == "Stop":
-                        await interaction.response.send_message(content=f"Please wait! You're past your queue limit of {settings.global_var.queue_limit}.", ephemeral=True)
-                    else:
-                        queuehandler.GlobalQueue.queue.append(queuehandler.UpscaleObject(upscalecog.UpscaleCog(self), *upscale_tuple, DeleteView(upscale_tuple)))
+                upscale_object = queuehandler.UpscaleObject(draw_dream, *upscale_tuple, DeleteView(upscale_tuple))
+                check = settings.queue_check(interaction.user, upscale_object)
+                if check is not None:
+                    await interaction.response.send_message(content=settings.queue_refusal(check), ephemeral=True)
                 else:
-                    await queuehandler.process_dream(draw_dream, queuehandler.UpscaleObject(upscalecog.UpscaleCog(self), *upscale_tuple, DeleteView(upscale_tuple)))
-
-                if user_queue_limit != "Stop":
+                    queue_position = queuehandler.submit(upscale_object)
                     await interaction.response.send_message(
                         f'<@{interaction.user.id}>, {settings.messages()}\nQueue: '
-                        f'``{len(queuehandler.GlobalQueue.queue)}`` - Upscaling')
+                        f'``{queue_position}`` - Upscaling')
             else:
                 await interaction.response.send_message("You can't upscale other people's images!", ephemeral=True)
         
@@ -0,0 +1,74 @@
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+from PIL import Image
+
+# run from anywhere, the bot's modules are one folder up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core import imagehandler
+
+PARAMETERS = 'a cat\nSteps: 20, Sampler: Euler a, CFG scale: 7, Seed: 1, Size: 512x512'
+
+
+# noise on a gradient, so the PNGs are about as hard to decode and encode as real drawings
+def make_png(size, seed):
+    rng = random.Random(seed)
+    image = Image.linear_gradient('L').resize(size).convert('RGB')
+    noise = Image.frombytes('RGB', size, rng.randbytes(size[0] * size[1] * 3))
+    image = Image.blend(image, noise, 0.5)
+    return imagehandler.encode_png(image, PARAMETERS)
+
+
+# the same grid layout stablecog uses for a square batch
+def build_grid(tiles, size):
+    cols = int(math.ceil(math.sqrt(len(tiles))))
+    rows = math.ceil(len(tiles) / cols)
+    grid = imagehandler.GridBuilder(len(tiles), cols, rows, size, PARAMETERS)
+    try:
+        for png_bytes in tiles:
+            grid.add(png_bytes)
+        return grid.finish('PNG')
+    finally:
+        grid.close()
+
+
+def run(counts, size, repeat):
+    results = {}
+    for count in counts:
+        tiles = [make_png(size, i) for i in range(count)]
+        build_grid(tiles, size)
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            build_grid(tiles, size)
+            times.append(time.perf_counter() - start)
+        results[count] = min(times)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times putting batch grids together, with and without image processes.')
+    parser.add_argument('--counts', type=int, nargs='+', default=[4, 16, 25], help='images in each batch')
+    parser.add_argument('--size', type=int, default=512, help='width and height of each image')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='image processes to compare against')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each batch, the fastest one counts')
+    args = parser.parse_args()
+    size = (args.size, args.size)
+
+    # threads first, the processes are forked once that's done
+    threaded = run(args.counts, size, args.repeat)
+    imagehandler.image_pool.start(args.processes)
+    pooled = run(args.counts, size, args.repeat)
+
+    print(f'{args.size}x{args.size} images, {args.processes} image processes, best of {args.repeat}')
+    print(f'{"images":>8} {"threads":>10} {"processes":>10} {"speed-up":>9}')
+    for count in args.counts:
+        print(f'{count:>8} {threaded[count]:>9.3f}s {pooled[count]:>9.3f}s {threaded[count] / pooled[count]:>8.2f}x')
+
+
+if __name__ == '__main__':
+    main()
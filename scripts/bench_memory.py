@@ -0,0 +1,124 @@
+import argparse
+import base64
+import io
+import math
+import multiprocessing
+import os
+import random
+import sys
+
+from PIL import Image
+
+# run from anywhere, the bot's modules are one folder up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core import imagehandler
+
+PARAMETERS = 'a cat\nSteps: 20, Sampler: Euler a, CFG scale: 7, Seed: 1, Size: 1024x1024'
+
+
+# a batch the way the Web UI sends it, as base64 PNGs
+def make_batch(count, size):
+    rng = random.Random(0)
+    gradient = Image.linear_gradient('L').resize(size).convert('RGB')
+    images = []
+    for _ in range(count):
+        noise = Image.frombytes('RGB', size, rng.randbytes(size[0] * size[1] * 3))
+        png_bytes = imagehandler.encode_png(Image.blend(gradient, noise, 0.5), PARAMETERS)
+        images.append(base64.b64encode(png_bytes).decode())
+    return images
+
+
+# resident memory of a process in MB, the current amount or the most it's been at
+def rss(field, pid='self'):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024
+    return 0
+
+
+# the most is only counted from here on, so making the batch doesn't count towards it
+def reset_peak():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        print("The peak can't be reset on this system, it includes making the batch.")
+
+
+# how the batch used to be handled: every image decoded and kept until the grid was made
+def all_at_once(image_data, size, cols, rows):
+    images = [Image.open(io.BytesIO(base64.b64decode(x))) for x in image_data]
+    for image in images:
+        image.load()
+    grid = Image.new('RGB', (cols * size[0], rows * size[1]))
+    for index, image in enumerate(images):
+        y, x = divmod(index, cols)
+        grid.paste(image, (x * size[0], y * size[1]))
+    return imagehandler.encode_image(grid, PARAMETERS)
+
+
+# how post_results handles it now: one image decoded at a time, straight into its tile
+def streaming(image_data, size, cols, rows):
+    grid = imagehandler.GridBuilder(len(image_data), cols, rows, size, PARAMETERS)
+    try:
+        for index in range(len(image_data)):
+            grid.add(base64.b64decode(image_data[index]))
+            image_data[index] = None
+        return grid.finish()
+    finally:
+        grid.close()
+
+
+# each way runs in a process of its own, so one's peak can't hide the other's
+def measure(mode, count, size, memory_limit, processes, results):
+    imagehandler.image_pool.memory_limit = memory_limit * 1024 * 1024
+    # the image processes are forked before the batch is made, so they don't start out holding a copy of it
+    if mode == 'streaming':
+        imagehandler.image_pool.start(processes)
+    image_data = make_batch(count, size)
+    cols = int(math.ceil(math.sqrt(count)))
+    rows = math.ceil(count / cols)
+    baseline = rss('VmRSS')
+    reset_peak()
+    if mode == 'streaming':
+        grid_bytes, _ = streaming(image_data, size, cols, rows)
+    else:
+        grid_bytes, _ = all_at_once(image_data, size, cols, rows)
+    peak = rss('VmHWM')
+    # the busiest image process, if there are any
+    executor = imagehandler.image_pool.executor
+    children = 0
+    if executor is not None:
+        children = max(rss('VmHWM', pid) for pid in executor._processes)
+        # this process exits by joining its children, which the image processes only are once they're shut down
+        executor.shutdown()
+    results.put((mode, baseline, peak, children, len(grid_bytes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the peak memory of putting a batch grid together.')
+    parser.add_argument('--count', type=int, default=25, help='images in the batch')
+    parser.add_argument('--size', type=int, default=1024, help='width and height of each image')
+    parser.add_argument('--memory-limit', type=int, default=0, help='grid_memory_limit in MB, 0 for no limit')
+    parser.add_argument('--processes', type=int, default=0, help='image_processes for the streaming run')
+    args = parser.parse_args()
+    size = (args.size, args.size)
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    print(f'{args.count} images of {args.size}x{args.size}, grid_memory_limit {args.memory_limit} MB, '
+          f'{args.processes} image processes')
+    print(f'{"mode":>12} {"batch":>9} {"peak":>9} {"added":>9} {"processes":>10} {"grid":>9}')
+    for mode in ('all_at_once', 'streaming'):
+        process = context.Process(target=measure, args=(mode, args.count, size, args.memory_limit, args.processes,
+                                                        results))
+        process.start()
+        mode, baseline, peak, children, grid_size = results.get()
+        process.join()
+        print(f'{mode:>12} {baseline:>6.0f} MB {peak:>6.0f} MB {peak - baseline:>6.0f} MB {children:>7.0f} MB '
+              f'{grid_size / 1024 / 1024:>6.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
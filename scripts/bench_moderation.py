@@ -0,0 +1,72 @@
+import argparse
+import os
+import random
+import string
+import sys
+import timeit
+
+# run from anywhere, the bot's modules are one folder up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core import settings
+
+
+def make_words(rng, count, length=(4, 10)):
+    return [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(*length))) for _ in range(count)]
+
+
+# how prompt_mod used to go through the lists, one entry at a time
+def old_mod(prompt, ban_list, ignore_list):
+    for x in ban_list:
+        x = str(x.lower())
+        if x in prompt.lower():
+            return "Stop", x
+    for y in ignore_list:
+        y = str(y.lower())
+        if y in prompt.lower():
+            prompt = prompt.replace(y, "")
+    return "Mod", ' '.join(prompt.split())
+
+
+# the same work with the patterns that are now compiled when config is loaded
+def new_mod(prompt, ban_pattern, ignore_pattern):
+    match = ban_pattern.search(prompt)
+    if match:
+        return "Stop", match.group(0).lower()
+    return "Mod", ' '.join(ignore_pattern.sub('', prompt).split())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times prompt moderation with the old loop and the compiled patterns.')
+    parser.add_argument('--entries', type=int, default=5000, help='entries in each of the ban and ignore lists')
+    parser.add_argument('--words', type=int, default=60, help='words in the prompt')
+    parser.add_argument('--number', type=int, default=200, help='prompts checked for each timing')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    ban_list = make_words(rng, args.entries)
+    ignore_list = make_words(rng, args.entries)
+    # nothing in the prompt is banned, so every entry has to be looked at, like most prompts
+    prompt = ' '.join(make_words(rng, args.words, (3, 9)))
+    for word in ban_list:
+        prompt = prompt.replace(word, '')
+    prompt = ' '.join(prompt.split())
+
+    start = timeit.default_timer()
+    ban_pattern = settings.word_pattern(ban_list, True, False)
+    ignore_pattern = settings.word_pattern(ignore_list, False, False)
+    compile_time = timeit.default_timer() - start
+
+    if old_mod(prompt, ban_list, ignore_list) != new_mod(prompt, ban_pattern, ignore_pattern):
+        print('The old loop and the patterns gave different results!')
+    old_time = min(timeit.repeat(lambda: old_mod(prompt, ban_list, ignore_list), number=args.number, repeat=3))
+    new_time = min(timeit.repeat(lambda: new_mod(prompt, ban_pattern, ignore_pattern), number=args.number, repeat=3))
+
+    print(f'{args.entries} entries in each list, {len(prompt.split())} word prompt, best of 3')
+    print(f'compiling both lists: {compile_time * 1000:.1f} ms, once per config load')
+    print(f'old loop:  {old_time / args.number * 1000:.3f} ms per prompt')
+    print(f'patterns:  {new_time / args.number * 1000:.3f} ms per prompt')
+    print(f'speed-up:  {old_time / new_time:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
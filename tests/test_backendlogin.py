@@ -0,0 +1,122 @@
+import asyncio
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from aiohttp import web
+
+from core import backendhandler
+
+
+# a Web UI stand-in started with --gradio-auth, which forgets its logins when it "restarts"
+class AuthServer:
+    def __init__(self):
+        self.logins = 0
+        self.sessions = set()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.url = asyncio.run_coroutine_threadsafe(self.start(), self.loop).result()
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/sdapi/v1/cmd-flags', self.guarded)
+        app.router.add_get('/sdapi/v1/options', self.guarded)
+        app.router.add_post('/login', self.login)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        await web.SockSite(self.runner, sock).start()
+        return f'http://127.0.0.1:{sock.getsockname()[1]}'
+
+    async def guarded(self, request):
+        if request.cookies.get('access-token') not in self.sessions:
+            return web.json_response({'detail': 'Not authenticated'}, status=401)
+        await asyncio.sleep(0.05)
+        return web.json_response({'sd_model_checkpoint': 'a.ckpt'})
+
+    async def login(self, request):
+        form = await request.post()
+        if form.get('password') != 'secret':
+            return web.json_response({'detail': 'Incorrect credentials.'}, status=400)
+        self.logins += 1
+        token = f'token{self.logins}'
+        self.sessions.add(token)
+        response = web.json_response({'success': True})
+        response.set_cookie('access-token', token)
+        return response
+
+    def restart(self):
+        self.sessions.clear()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+@pytest.fixture
+def server():
+    server = AuthServer()
+    yield server
+    server.close()
+
+
+def session(server, password='secret'):
+    backend = backendhandler.Backend(server.url)
+    return backend, backendhandler.BackendSession(backend, {'username': 'aiya', 'password': password})
+
+
+def test_a_401_before_the_probe_logs_in_and_tries_again(server):
+    backend, s = session(server)
+    assert backend.gradio_auth is None
+    response = s.get(f'{server.url}/sdapi/v1/options')
+    assert response.status_code == 200
+    assert backend.gradio_auth is True
+    assert server.logins == 1
+
+
+def test_threads_turned_away_at_once_only_log_in_once(server):
+    backend, s = session(server)
+    s.login()
+    server.restart()
+    with ThreadPoolExecutor(8) as executor:
+        responses = list(executor.map(lambda _: s.get(f'{server.url}/sdapi/v1/options'), range(8)))
+    assert [x.status_code for x in responses] == [200] * 8
+    assert server.logins == 2
+
+
+def test_a_failed_login_raises(server):
+    backend, s = session(server, 'wrong')
+    with pytest.raises(PermissionError):
+        s.get(f'{server.url}/sdapi/v1/options')
+
+
+def test_the_client_logs_in_once_for_jobs_turned_away_at_once(server):
+    async def main():
+        backend = backendhandler.Backend(server.url)
+        client = backendhandler.BackendClient(backend, {'username': 'aiya', 'password': 'secret'})
+        try:
+            await client.options()
+            server.restart()
+            responses = await asyncio.gather(*[client.options() for _ in range(8)])
+        finally:
+            await client.session.close()
+        return [x.status_code for x in responses]
+
+    assert asyncio.run(main()) == [200] * 8
+    assert server.logins == 2
+
+
+def test_the_client_raises_when_it_cant_log_in(server):
+    async def main():
+        backend = backendhandler.Backend(server.url)
+        client = backendhandler.BackendClient(backend, {'username': 'aiya', 'password': 'wrong'})
+        try:
+            await client.options()
+        finally:
+            await client.session.close()
+
+    with pytest.raises(PermissionError):
+        asyncio.run(main())
@@ -0,0 +1,67 @@
+import asyncio
+from types import SimpleNamespace
+
+from core import backendhandler
+
+
+# stands in for a BackendClient, with the checkpoint that's loaded on the Web UI itself
+class FakeClient:
+    def __init__(self, checkpoint):
+        self.checkpoint = checkpoint
+        self.posted = []
+
+    async def options(self):
+        return SimpleNamespace(status_code=200, json=lambda: {'sd_model_checkpoint': self.checkpoint})
+
+    async def set_options(self, options):
+        self.posted.append(options)
+        self.checkpoint = options.get('sd_model_checkpoint', self.checkpoint)
+        return SimpleNamespace(status_code=200)
+
+
+def test_a_checkpoint_changed_on_the_web_ui_is_seen_on_refresh():
+    async def main():
+        backend = backendhandler.Backend('http://127.0.0.1:1')
+        client = FakeClient('a.ckpt')
+        await backend.set_options(client, {'sd_model_checkpoint': 'a.ckpt'})
+        client.checkpoint = 'b.ckpt'
+        # the cache doesn't know yet, so the swap back would be skipped
+        assert await backend.set_options(client, {'sd_model_checkpoint': 'a.ckpt'}) == {}
+        await backend.refresh_options(client)
+        assert backend.sd_model == 'b.ckpt'
+        assert await backend.set_options(client, {'sd_model_checkpoint': 'a.ckpt'}) == {'sd_model_checkpoint': 'a.ckpt'}
+        assert client.checkpoint == 'a.ckpt'
+
+    asyncio.run(main())
+
+
+def test_a_recovered_backend_forgets_its_options():
+    async def main():
+        backend = backendhandler.Backend('http://127.0.0.1:1')
+        client = FakeClient('a.ckpt')
+        await backend.set_options(client, {})
+        backend.healthy = False
+        client.checkpoint = 'b.ckpt'
+        backend.mark_up()
+        assert backend.sd_model is None
+        assert await backend.set_options(client, {'sd_model_checkpoint': 'a.ckpt'}) == {'sd_model_checkpoint': 'a.ckpt'}
+
+    asyncio.run(main())
+
+
+def test_options_forgotten_during_a_post_stay_forgotten():
+    async def main():
+        backend = backendhandler.Backend('http://127.0.0.1:1')
+        client = FakeClient('a.ckpt')
+        await backend.set_options(client, {})
+        set_options = client.set_options
+
+        async def slow_set_options(options):
+            backend.options = None
+            return await set_options(options)
+
+        client.set_options = slow_set_options
+        await backend.set_options(client, {'sd_model_checkpoint': 'b.ckpt'})
+        assert backend.options is None
+
+    asyncio.run(main())
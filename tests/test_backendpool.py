@@ -0,0 +1,181 @@
+import asyncio
+import socket
+import time
+from types import SimpleNamespace
+
+from aiohttp import web
+
+from core import backendhandler
+from core import queuehandler
+
+
+# a Web UI stand-in that takes a little while to interrogate, and counts what it was sent
+async def start_server():
+    hits = []
+
+    async def interrogate(request):
+        hits.append(request.path)
+        await asyncio.sleep(0.2)
+        return web.json_response({'caption': 'a cat'})
+
+    async def cmd_flags(_request):
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post('/sdapi/v1/interrogate', interrogate)
+    app.router.add_get('/sdapi/v1/cmd-flags', cmd_flags)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    site = web.SockSite(runner, sock)
+    await site.start()
+    return runner, f'http://127.0.0.1:{sock.getsockname()[1]}', hits
+
+
+class FakeCog:
+    qualified_name = 'FakeCog'
+
+    def __init__(self):
+        self.results = []
+
+    async def dream(self, _event_loop, queue_object):
+        client = backendhandler.BackendClient(queue_object.backend)
+        try:
+            response = await client.interrogate({})
+            self.results.append((queue_object.backend.url, response.status_code))
+        except Exception as e:
+            self.results.append((queue_object.backend.url, e))
+        finally:
+            await client.session.close()
+
+
+def identify(cog):
+    ctx = SimpleNamespace(author=SimpleNamespace(id=1), guild=None, channel=SimpleNamespace(id=1))
+    return queuehandler.IdentifyObject(cog, ctx, None, 'CLIP', None)
+
+
+async def run_jobs(scheduler, cog, count, timeout=5):
+    for _ in range(count):
+        scheduler.submit(identify(cog))
+    deadline = time.time() + timeout
+    while len(cog.results) < count and time.time() < deadline:
+        await asyncio.sleep(0.05)
+    for task in scheduler.workers:
+        task.cancel()
+    scheduler.executor.shutdown(wait=False)
+
+
+def test_jobs_wait_for_a_busy_backend_instead_of_one_that_is_down():
+    async def main():
+        runner_a, url_a, hits_a = await start_server()
+        runner_b, url_b, hits_b = await start_server()
+        # B goes away, and the pool has already noticed
+        await runner_b.cleanup()
+        backendhandler.pool.configure(url_a, [url_b])
+        backendhandler.pool.jobs_per_backend = 1
+        backendhandler.pool.backends[1].mark_down()
+
+        scheduler = queuehandler.Scheduler()
+        scheduler.configure_lane('light', 2, 1)
+        cog = FakeCog()
+        try:
+            await run_jobs(scheduler, cog, 2)
+        finally:
+            await runner_a.cleanup()
+        return cog.results, hits_a, hits_b, url_a
+
+    results, hits_a, hits_b, url_a = asyncio.run(main())
+    assert results == [(url_a, 200), (url_a, 200)]
+    assert len(hits_a) == 2
+    assert hits_b == []
+
+
+def test_jobs_go_to_a_backend_again_once_it_can_be_retried():
+    async def main():
+        runner, url, hits = await start_server()
+        backendhandler.pool.configure(url, [])
+        backendhandler.pool.jobs_per_backend = 1
+        backend = backendhandler.pool.backends[0]
+        backend.mark_down()
+        backend.retry_at = time.time() + 0.3
+
+        scheduler = queuehandler.Scheduler()
+        scheduler.configure_lane('light', 1, 1)
+        cog = FakeCog()
+        try:
+            await run_jobs(scheduler, cog, 1)
+        finally:
+            await runner.cleanup()
+        return cog.results, hits, url
+
+    results, hits, url = asyncio.run(main())
+    assert results == [(url, 200)]
+    assert len(hits) == 1
+
+
+def test_jobs_are_shared_out_by_weight():
+    pool = backendhandler.BackendPool()
+    pool.configure('http://a', [{'url': 'http://b', 'weight': 3}, 'http://c'])
+    pool.jobs_per_backend = 100
+    for _ in range(50):
+        pool.acquire()
+    assert [x.outstanding for x in pool.backends] == [10, 30, 10]
+    # the next job goes to whichever has the least per unit of weight
+    pool.release(pool.backends[1])
+    pool.release(pool.backends[1])
+    assert pool.acquire() is pool.backends[1]
+
+
+def test_a_full_backend_is_passed_over_until_a_job_is_released():
+    pool = backendhandler.BackendPool()
+    pool.configure('http://a', [{'url': 'http://b', 'weight': 10}])
+    pool.jobs_per_backend = 2
+    backends = [pool.acquire() for _ in range(4)]
+    assert sorted(x.url for x in backends) == ['http://a', 'http://a', 'http://b', 'http://b']
+    assert not pool.has_room()
+    pool.release(backends.pop(0))
+    assert pool.has_room()
+    backends.append(pool.acquire())
+    assert not pool.has_room()
+    for backend in backends:
+        pool.release(backend)
+    assert [x.outstanding for x in pool.backends] == [0, 0]
+
+
+def test_refresh_keeps_the_jobs_a_backend_has_out():
+    pool = backendhandler.BackendPool()
+    pool.configure('http://a', ['http://b'])
+    pool.jobs_per_backend = 2
+    backend = pool.acquire()
+    pool.configure('http://a', [{'url': 'http://b', 'weight': 2}])
+    assert pool.backends[0].outstanding + pool.backends[1].outstanding == 1
+    pool.release(backend)
+    assert [x.outstanding for x in pool.backends] == [0, 0]
+
+
+def test_every_job_gives_its_backend_back_even_when_it_fails():
+    async def main():
+        runner_a, url_a, hits_a = await start_server()
+        runner_b, url_b, hits_b = await start_server()
+        # B goes away without the pool knowing yet, so its jobs fail
+        await runner_b.cleanup()
+        backendhandler.pool.configure(url_a, [url_b])
+        backendhandler.pool.jobs_per_backend = 2
+        for backend in backendhandler.pool.backends:
+            backend.outstanding = 0
+            backend.mark_up()
+
+        scheduler = queuehandler.Scheduler()
+        scheduler.configure_lane('light', 4, 1)
+        cog = FakeCog()
+        try:
+            await run_jobs(scheduler, cog, 4)
+        finally:
+            await runner_a.cleanup()
+        return cog.results, url_a, url_b
+
+    results, url_a, url_b = asyncio.run(main())
+    assert len(results) == 4
+    assert any(url == url_b and isinstance(result, Exception) for url, result in results)
+    assert [x.outstanding for x in backendhandler.pool.backends] == [0, 0]
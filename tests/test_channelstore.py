@@ -0,0 +1,47 @@
+import pytest
+
+from core import settings
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = settings.ChannelStore()
+    store.open(str(tmp_path / 'channels.db'))
+    monkeypatch.setattr(settings, 'channel_store', store)
+    monkeypatch.setattr(settings, 'channel_cache', settings.SettingsCache())
+    monkeypatch.setattr(settings.global_var, 'model_info', {'Anime': ('anime.ckpt [1]', 'anime', '1', ''),
+                                                            'Photo': ('photo.ckpt [2]', 'photo', '2', '')})
+    monkeypatch.setitem(settings.template, 'data_model', 'Photo')
+    store.save('1', {'data_model': 'Anime'})
+    store.save('2', {'data_model': 'Gone'})
+    store.save('3', {'data_model': 'Gone'})
+    store.save('4', {'data_model': ''})
+    store.save('5', {'steps': 20})
+    return store
+
+
+def test_models_and_find_model(store):
+    assert sorted(store.models()) == ['', 'Anime', 'Gone']
+    assert sorted(store.find_model('Gone')) == ['2', '3']
+    assert store.find_model('Nothing') == []
+
+
+def test_models_use_the_data_model_index(store):
+    plan = store.connection.execute("EXPLAIN QUERY PLAN SELECT channel_id FROM channels "
+                                    "WHERE json_extract(settings, '$.data_model') = ?", ('Gone',)).fetchall()
+    assert any('channels_model' in row[-1] for row in plan)
+
+
+def test_channels_on_a_missing_model_go_back_to_the_default(store):
+    settings.reset_missing_models()
+    assert store.load('1')['data_model'] == 'Anime'
+    assert store.load('2')['data_model'] == 'Photo'
+    assert store.load('3')['data_model'] == 'Photo'
+    assert store.load('4')['data_model'] == ''
+    assert 'data_model' not in store.load('5')
+
+
+def test_nothing_is_reset_when_the_web_ui_lists_no_models(store, monkeypatch):
+    monkeypatch.setattr(settings.global_var, 'model_info', {'Default': ('', '', '', '')})
+    settings.reset_missing_models()
+    assert store.load('2')['data_model'] == 'Gone'
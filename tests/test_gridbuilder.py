@@ -0,0 +1,60 @@
+import io
+import random
+import zlib
+
+import pytest
+from PIL import Image
+
+from core import imagehandler
+
+PARAMETERS = 'a cat\nSteps: 20, Seed: 1'
+
+
+def make_tiles(count, size):
+    rng = random.Random(count)
+    gradient = Image.linear_gradient('L').resize(size).convert('RGB')
+    tiles = []
+    for _ in range(count):
+        noise = Image.frombytes('RGB', size, rng.randbytes(size[0] * size[1] * 3))
+        tiles.append(imagehandler.encode_png(Image.blend(gradient, noise, 0.3), PARAMETERS))
+    return tiles
+
+
+def build(tiles, size, cols, rows):
+    grid = imagehandler.GridBuilder(len(tiles), cols, rows, size, PARAMETERS)
+    for png_bytes in tiles:
+        grid.add(png_bytes)
+    return grid.finish('PNG')
+
+
+@pytest.fixture(scope='module')
+def pool():
+    pool = imagehandler.ImagePool()
+    pool.start(2)
+    yield pool
+    pool.executor.shutdown()
+
+
+@pytest.mark.parametrize('count, cols, rows', [(4, 2, 2), (5, 3, 2), (16, 4, 4)])
+def test_processes_make_the_same_grid_as_threads(pool, monkeypatch, count, cols, rows):
+    size = (48, 40)
+    tiles = make_tiles(count, size)
+    threaded, threaded_ext = build(tiles, size, cols, rows)
+    monkeypatch.setattr(imagehandler, 'image_pool', pool)
+    pooled, pooled_ext = build(tiles, size, cols, rows)
+    assert threaded_ext == pooled_ext == 'png'
+    threaded_image = Image.open(io.BytesIO(threaded))
+    pooled_image = Image.open(io.BytesIO(pooled))
+    assert pooled_image.size == threaded_image.size
+    assert pooled_image.tobytes() == threaded_image.tobytes()
+    assert pooled_image.info['parameters'] == PARAMETERS
+    # zlib checks the combined checksum, PIL doesn't
+    zlib.decompress(imagehandler.idat_data(pooled))
+
+
+def test_adler32_combine():
+    rng = random.Random(0)
+    for _ in range(50):
+        first, second = rng.randbytes(rng.randint(0, 70000)), rng.randbytes(rng.randint(0, 70000))
+        combined = imagehandler.adler32_combine(zlib.adler32(first), zlib.adler32(second), len(second))
+        assert combined == zlib.adler32(first + second)